@@ -1,4 +1,5 @@
 import os
+import json
 import cv2
 import torch
 import numpy as np
@@ -10,13 +11,15 @@ from torchmetrics.image.fid import FrechetInceptionDistance
 from PIL import Image
 
 from tqdm import tqdm
-from ema_pytorch import EMA
 from ..models import define_G
 from itertools import product
 from os.path import join as opj
 from skimage.metrics import structural_similarity
 from skimage.metrics import peak_signal_noise_ratio
 from ..utils import normalize_image, unnormalize_image, tta, untta
+from ..utils import normalize_batch, unnormalize_batch, load_manifest
+from ..utils import DevicePrefetcher, ImageReader, crop_grid, strip_ema_prefix
+from ..utils import StageTimer, StepProfiler, profile_regions
 
 
 def load_image_as_tensor(image_path, image_size=(1024, 1024)):
@@ -61,11 +64,15 @@ class BCIEvaluatorCAHR(object):
         self.apply_tta   = apply_tta
         self.infer_mode  = configs.trainer.infer_mode
         self.norm_method = configs.loader.norm_method
+        self.device_norm = configs.loader.get('device_norm', False)
+        self.channels_last = configs.trainer.get('channels_last', False)
+        self.memory_format = torch.channels_last if self.channels_last \
+                             else torch.contiguous_format
 
         # model
         self.G_params = configs.G
         self.device   = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self.ema      = configs.trainer.ema
+        self.profile_params = configs.get('profile', {})
         self._load_model(model_path)
 
         # dataset
@@ -81,19 +88,12 @@ class BCIEvaluatorCAHR(object):
 
     def _load_model(self, model_path):
 
+        # models of ema are saved as plain G, while models saved by EMA
+        # of ema-pytorch also contain online G, which is dropped
         self.G = define_G(self.G_params)
-        if self.ema:
-            self.G = EMA(
-                self.G,
-                beta=0.99,
-                update_after_step=100,
-                update_every=1,
-                power=1.0
-            )
-
         G_dict = torch.load(model_path, map_location='cpu')
-        self.G.load_state_dict(G_dict)
-        self.G = self.G.to(self.device)
+        self.G.load_state_dict(strip_ema_prefix(G_dict))
+        self.G = self.G.to(self.device, memory_format=self.memory_format)
         self.G.eval()
 
         return
@@ -104,27 +104,46 @@ class BCIEvaluatorCAHR(object):
         pred_dir = opj(output_dir, 'IHC_pred')
         os.makedirs(pred_dir, exist_ok=True)
         metrics_path = opj(output_dir, 'metrics.csv')
+        timing_path  = opj(output_dir, 'timing.json')
 
         he_dir  = opj(data_dir, 'HE')
         ihc_dir = opj(data_dir, 'IHC')
-        files   = os.listdir(he_dir)
-        files.sort()
-
+        files   = [s['file'] for s in load_manifest(data_dir)]
+
+        # next images are decoded in background while predicting
+        he_paths  = [opj(he_dir, file) for file in files]
+        he_images = DevicePrefetcher(ImageReader(he_paths), 'cpu')
+
+        # seconds of stages of predicting and evaluating, device is
+        # synchronized as each prediction is copied to host
+        self.timer = StageTimer(self.device, sync=True)
+
+        # predictions are profiled from the start if enabled in profile
+        # configs, or once the process gets the profile signal
+        profiler = StepProfiler(
+            self.profile_params, opj(output_dir, 'profile'), self.device,
+            regions=lambda: profile_regions(self.G), name='eval'
+        )
         fid_model = FrechetInceptionDistance(feature=64)
         metrics_list = []
-        for file in tqdm(files, ncols=88):
+        for file, he_ori in tqdm(zip(files, he_images), total=len(files), ncols=88):
             he_path = opj(he_dir, file)
             ihc_path = opj(ihc_dir, file)
             ihc_pred_path = opj(pred_dir, file)
+            self.timer.add('wait', he_images.wait_time)
 
             if self.apply_tta:
-                self.predict_tta(he_path, ihc_pred_path)
+                self.predict_tta(he_ori, ihc_pred_path)
             else:
-                self.predict(he_path, ihc_pred_path)
+                self.predict(he_ori, ihc_pred_path)
 
             psnr, ssim = self.evaluate(ihc_path, ihc_pred_path)
-            update_fid_model(fid_model, ihc_path, ihc_pred_path)
+            with self.timer('fid'):
+                update_fid_model(fid_model, ihc_path, ihc_pred_path)
             metrics_list.append([he_path, ihc_path, ihc_pred_path, psnr, ssim])
+            profiler.step()
+
+        profiler.stop()
 
         columns = ['he', 'ihc', 'ihc_pred', 'psnr', 'ssim']
         metrics = pd.DataFrame(metrics_list, columns=columns)
@@ -139,83 +158,93 @@ class BCIEvaluatorCAHR(object):
         print(f'- PSNR:   {psnr_avg:.3f} ± {psnr_std:.3f}')
         print(f'- SSIM:   {ssim_avg:.3f} ± {ssim_std:.3f}')
         print(f"- FID:    {fid_model.compute():.5f}")
+        print(f'- Wait:   {he_images.total_wait:.3f}s for decoding inputs')
+
+        timing = {k: round(v, 6) for k, v in self.timer.summary().items()}
+        with open(timing_path, mode='w', encoding='utf-8') as f:
+            f.write(json.dumps(timing) + '\n')
+        print('- Time:  ', ' '.join(f'{k[5:]}:{v:.3f}s' for k, v in timing.items()))
 
         return
 
-    @torch.no_grad()
-    def predict(self, he_path, ihc_pred_path):
+    def _to_input(self, he_ori):
+
+        if self.device_norm:
+            he = np.ascontiguousarray(he_ori)[None, ...]
+            he = torch.from_numpy(he).to(self.device)
+            he = normalize_batch(he, 'he', self.norm_method, self.channels_last)
+        else:
+            he = normalize_image(he_ori, 'he', self.norm_method, channels_first=True)
+            he = torch.from_numpy(he[None, ...]).to(self.device)
+            he = he.contiguous(memory_format=self.memory_format)
+
+        # overlapping crops in order of self.crop_rows_cols
+        he_crop = crop_grid(he, self.crop_size)
+
+        return he, he_crop
+
+    def _to_output(self, ihc_pred, to_uint8=False):
+
+        if self.device_norm:
+            ihc_pred = unnormalize_batch(ihc_pred, 'ihc', self.norm_method, to_uint8)
+            ihc_pred = ihc_pred[0].cpu().numpy()
+        else:
+            ihc_pred = ihc_pred[0].cpu().numpy()
+            ihc_pred = ihc_pred.transpose(1, 2, 0)
+            ihc_pred = unnormalize_image(ihc_pred, 'ihc', self.norm_method, to_uint8)
+
+        return ihc_pred
 
-        he_ori  = iio.imread(he_path)
-        he = normalize_image(he_ori, 'he', self.norm_method)
-        he = he.transpose(2, 0, 1).astype(np.float32)[None, ...]
-        he = torch.Tensor(he).to(self.device)
+    @torch.no_grad()
+    def predict(self, he_ori, ihc_pred_path):
 
-        he_crop = self._crop(he_ori)
-        he_crop = normalize_image(he_crop, 'he', self.norm_method)
-        he_crop = he_crop.transpose(0, 3, 1, 2).astype(np.float32)
-        he_crop = torch.Tensor(he_crop).to(self.device)
+        with self.timer('h2d'):
+            he, he_crop = self._to_input(he_ori)
 
-        multi_outputs = self.G(he, he_crop, self.crop_idxs, self.infer_mode)
+        with self.timer('G_fwd'):
+            multi_outputs = self.G(he, he_crop, self.crop_idxs, self.infer_mode)
         ihc_pred = multi_outputs[0]
-        ihc_pred = ihc_pred[0].cpu().numpy()
-        ihc_pred = ihc_pred.transpose(1, 2, 0)
-        ihc_pred = unnormalize_image(ihc_pred, 'ihc', self.norm_method)
-        ihc_pred = ihc_pred.astype(np.uint8)
+        with self.timer('d2h'):
+            ihc_pred = self._to_output(ihc_pred, to_uint8=True)
 
-        iio.imwrite(ihc_pred_path, ihc_pred)
+        with self.timer('write'):
+            iio.imwrite(ihc_pred_path, ihc_pred)
 
         return
     
     @torch.no_grad()
-    def predict_tta(self, he_path, ihc_pred_path):
-
-        he_ori = iio.imread(he_path)
+    def predict_tta(self, he_ori, ihc_pred_path):
 
         ihc_pred_tta = np.zeros_like(he_ori).astype(np.float32)
         for i in range(7):
             he_tta = tta(he_ori, i)
-            he = normalize_image(he_tta, 'he', self.norm_method)
-            he = he.transpose(2, 0, 1).astype(np.float32)[None, ...]
-            he = torch.Tensor(he).to(self.device)
-
-            he_crop = self._crop(he_tta)
-            he_crop = normalize_image(he_crop, 'he', self.norm_method)
-            he_crop = he_crop.transpose(0, 3, 1, 2).astype(np.float32)
-            he_crop = torch.Tensor(he_crop).to(self.device)
+            with self.timer('h2d'):
+                he, he_crop = self._to_input(he_tta)
 
-            multi_outputs = self.G(he, he_crop, self.crop_idxs, self.infer_mode)
+            with self.timer('G_fwd'):
+                multi_outputs = self.G(he, he_crop, self.crop_idxs, self.infer_mode)
             ihc_pred = multi_outputs[0]
-            ihc_pred = ihc_pred[0].cpu().numpy()
-            ihc_pred = ihc_pred.transpose(1, 2, 0)
-            ihc_pred = unnormalize_image(ihc_pred, 'ihc', self.norm_method)
+            with self.timer('d2h'):
+                ihc_pred = self._to_output(ihc_pred)
 
             ihe_pred_untta = untta(ihc_pred, i)
             ihc_pred_tta += ihe_pred_untta
 
         ihc_pred_tta /= 7
         ihc_pred_tta = ihc_pred_tta.astype(np.uint8)
-        iio.imwrite(ihc_pred_path, ihc_pred_tta)
+        with self.timer('write'):
+            iio.imwrite(ihc_pred_path, ihc_pred_tta)
 
         return
 
     def evaluate(self, ihc_path, ihc_pred_path):
 
-        real = cv2.imread(ihc_path)
-        fake = cv2.imread(ihc_pred_path)
-        psnr = peak_signal_noise_ratio(fake, real)
-        ssim = structural_similarity(fake, real, multichannel=True)
+        # predictions are read back as written to png
+        with self.timer('reread'):
+            real = cv2.imread(ihc_path)
+            fake = cv2.imread(ihc_pred_path)
+        with self.timer('metric'):
+            psnr = peak_signal_noise_ratio(fake, real)
+            ssim = structural_similarity(fake, real, multichannel=True)
 
         return psnr, ssim
-
-    def _crop(self, he):
-
-        he_crop_list = []
-        for row_idx, col_idx in self.crop_rows_cols:
-            he_crop = he[
-                row_idx:row_idx + self.crop_size,
-                col_idx:col_idx + self.crop_size
-            ].copy()
-            he_crop_list.append(he_crop)
-        he_crop = np.array(he_crop_list)
-
-        return he_crop
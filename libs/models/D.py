@@ -39,17 +39,16 @@ class MultiscaleDiscriminator(nn.Module):
     def singleD_forward(self, model, input):
         return [model(input)]
 
-    def forward(self, input):
+    def forward(self, input, pyramid=None):
+        # pyramid contains input of each depth, which can be
+        # precomputed for real images, downsampled here if not given
+        if pyramid is None:
+            pyramid = downsample_pyramid(input, self.num_depths)
+
         result = []
-        input_downsampled = input
         for i in range(self.num_depths):
             model = getattr(self, 'layer' + str(self.num_depths - 1 - i))
-            result.append(self.singleD_forward(model, input_downsampled))
-            if i != (self.num_depths - 1):
-                input_downsampled = F.interpolate(
-                    input_downsampled, scale_factor=0.5,
-                    mode='bilinear', align_corners=True
-                )
+            result.append(self.singleD_forward(model, pyramid[i]))
         return result
 
 
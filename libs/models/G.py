@@ -61,7 +61,7 @@ class BCIStainerBasic(nn.Module):
                     sampling='none', attention=False
                 )
             )
-        self.encoder1 = nn.Sequential(*encoder1)
+        self.encoder1 = CheckpointSequential(*encoder1)
 
         style_dims = conv_dims = out_dims
         total_encoder_blocks = int(np.log2(full_size / 8))
@@ -113,7 +113,7 @@ class BCIStainerBasic(nn.Module):
                     attention=attention
                 )
             decoder1.append(layer)
-        self.decoder1 = nn.Sequential(*decoder1)
+        self.decoder1 = CheckpointSequential(*decoder1)
 
         self.output_lowres = output_lowres
         if self.output_lowres:
@@ -140,7 +140,7 @@ class BCIStainerBasic(nn.Module):
                     sampling='none', attention=False
                 )
             )
-        self.decoder2 = nn.Sequential(*decoder2)
+        self.decoder2 = CheckpointSequential(*decoder2)
 
         self.highres_outconv = nn.Sequential(
             nn.ReflectionPad2d(3),
@@ -151,6 +151,13 @@ class BCIStainerBasic(nn.Module):
             nn.Tanh()
         )
 
+    def set_checkpointing(self, encoder1=0, decoder1=0, decoder2=0):
+        # number of checkpointed segments of each stack, 0 to disable
+        self.encoder1.segments = encoder1
+        self.decoder1.segments = decoder1
+        self.decoder2.segments = decoder2
+        return
+
     def forward(self, he):
 
         he_in = self.inconv(he)
@@ -221,7 +228,7 @@ class BCIStainerCAHR(nn.Module):
                     sampling='none', attention=False
                 )
             )
-        self.encoder1 = nn.Sequential(*encoder1)
+        self.encoder1 = CheckpointSequential(*encoder1)
 
         style_dims = conv_dims = out_dims
         total_encoder_blocks = int(np.log2(full_size / 8))
@@ -273,7 +280,7 @@ class BCIStainerCAHR(nn.Module):
                     attention=attention
                 )
             decoder1.append(layer)
-        self.decoder1 = nn.Sequential(*decoder1)
+        self.decoder1 = CheckpointSequential(*decoder1)
 
         self.output_lowres = output_lowres
         if self.output_lowres:
@@ -300,7 +307,7 @@ class BCIStainerCAHR(nn.Module):
                     sampling='none', attention=False
                 )
             )
-        self.decoder2 = nn.Sequential(*decoder2)
+        self.decoder2 = CheckpointSequential(*decoder2)
 
         self.highres_outconv = nn.Sequential(
             nn.ReflectionPad2d(3),
@@ -324,6 +331,15 @@ class BCIStainerCAHR(nn.Module):
             nn.Sigmoid()
         )
 
+    def set_checkpointing(self, encoder1=0, decoder1=0, decoder2=0):
+        # number of checkpointed segments of each stack, 0 to disable,
+        # mask decoder has the same layers as decoder2
+        self.encoder1.segments = encoder1
+        self.decoder1.segments = decoder1
+        self.decoder2.segments = decoder2
+        self.mask_decoder.segments = decoder2
+        return
+
     def _forward_full(self, he):
 
         outputs_dict = {}
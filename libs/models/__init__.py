@@ -1,3 +1,5 @@
 from .G import define_G
 from .C import define_C
 from .D import define_D
+from .utils import downsample_pyramid, convert_split_batchnorm
+from .utils import SplitBatchNorm2d
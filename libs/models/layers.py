@@ -1,9 +1,12 @@
 import math
 import torch
+import contextlib
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 
+from torch.utils.checkpoint import checkpoint
+
 
 class SimAM(nn.Module):
 
@@ -195,13 +198,34 @@ class ModConv2d(nn.Module):
         x, style = x_in
         b, _, h, w = x.shape
 
-        style_ = style[:, None, :, None, None]
-        weights = self.weight()[None, :, :, :, :]
-        weights = weights * (style_ + 1)
+        # modulation and demodulation are kept in fp32 under autocast
+        style_ = style.float()[:, None, :, None, None]
+        weight = self.weight()
+        weights = weight[None, :, :, :, :] * (style_ + 1)
 
         if self.demodulate:
             sigma_inv = torch.rsqrt((weights ** 2).sum(dim=(2, 3, 4), keepdim=True) + self.eps)
-            weights = weights * sigma_inv
+
+        if x.is_contiguous(memory_format=torch.channels_last):
+            # inputs are modulated instead of weights, then a dense conv
+            # keeps channels last format, which is lost in grouped conv
+            x = x * (style_[:, 0] + 1)
+            x = F.pad(x, self.padding, mode='reflect')
+            x = F.conv2d(x, weight, padding=0)
+            if self.demodulate:
+                x = x * sigma_inv.view(b, self.out_dim, 1, 1).to(x.dtype)
+        else:
+            if self.demodulate:
+                weights = weights * sigma_inv
+            x = self._grouped_conv(x, weights)
+
+        if self.use_bias:
+            x += self.bias[None, :, None, None]
+
+        return x
+
+    def _grouped_conv(self, x, weights):
+        b, _, h, w = x.shape
 
         _, _, *ws = weights.shape
         weights = weights.reshape(b * self.out_dim, *ws)
@@ -211,9 +235,6 @@ class ModConv2d(nn.Module):
         x = F.conv2d(x, weights, padding=0, groups=b)
         x = x.reshape(-1, self.out_dim, h, w)
 
-        if self.use_bias:
-            x += self.bias[None, :, None, None]
-
         return x
 
 
@@ -270,3 +291,57 @@ class ResnetModBlock(nn.Module):
             out = self.atten(out)
 
         return (x_in + out) / math.sqrt(2), style
+
+
+class CheckpointSequential(nn.Sequential):
+    # layers are split into segments, only inputs of each segment are
+    # kept in forward and activations inside are recomputed in backward,
+    # keys of state dict are the same as nn.Sequential
+
+    def __init__(self, *layers):
+        super(CheckpointSequential, self).__init__(*layers)
+        self.segments = 0
+
+    def forward(self, x):
+
+        if (self.segments <= 0) or (not torch.is_grad_enabled()):
+            return super(CheckpointSequential, self).forward(x)
+
+        # non-reentrant checkpoint accepts (x, style) as input,
+        # and restores rng states for dropout in recomputation
+        size = math.ceil(len(self) / self.segments)
+        for start in range(0, len(self), size):
+            x = checkpoint(
+                self._forward_segment, x, start, start + size,
+                use_reentrant=False, context_fn=self._context_fn
+            )
+
+        return x
+
+    def _forward_segment(self, x, start, end):
+        for layer in self[start:end]:
+            x = layer(x)
+        return x
+
+    def _context_fn(self):
+        return contextlib.nullcontext(), self._no_bn_update()
+
+    @contextlib.contextmanager
+    def _no_bn_update(self):
+        # running statistics of batch norm are updated only once, in forward,
+        # zero momentum keeps them in recomputation, which still normalizes
+        # with batch statistics and saves the same tensors for backward
+        bns = [
+            (m, m.momentum, m.num_batches_tracked.clone())
+            for m in self.modules()
+            if isinstance(m, nn.modules.batchnorm._BatchNorm)
+            and m.training and m.track_running_stats
+        ]
+        for m, _, _ in bns:
+            m.momentum = 0.0
+        try:
+            yield
+        finally:
+            for m, momentum, num_batches_tracked in bns:
+                m.momentum = momentum
+                m.num_batches_tracked.copy_(num_batches_tracked)
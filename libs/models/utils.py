@@ -1,5 +1,7 @@
+import torch
 import functools
 import torch.nn as nn
+import torch.nn.functional as F
 
 from torch.nn import init 
 
@@ -23,6 +25,52 @@ def get_norm_layer(norm_type='instance'):
     return norm_layer
 
 
+class SplitBatchNorm2d(nn.BatchNorm2d):
+    # in training, input is split into num_splits chunks along batch, and
+    # each chunk is normalized with its own statistics and updates running
+    # statistics in turn, as if chunks were forwarded separately
+
+    def __init__(self, *args, **kwargs):
+        super(SplitBatchNorm2d, self).__init__(*args, **kwargs)
+        self.num_splits = 1
+
+    def forward(self, x):
+
+        if (self.num_splits <= 1) or (not self.training):
+            return super(SplitBatchNorm2d, self).forward(x)
+
+        chunks = x.chunk(self.num_splits)
+        return torch.cat([
+            super(SplitBatchNorm2d, self).forward(chunk)
+            for chunk in chunks
+        ])
+
+
+def convert_split_batchnorm(module):
+    # replaces BatchNorm2d layers with SplitBatchNorm2d, which share
+    # their parameters and buffers, keys of state dict are unchanged
+
+    module_output = module
+    if isinstance(module, nn.BatchNorm2d) and \
+            not isinstance(module, SplitBatchNorm2d):
+        module_output = SplitBatchNorm2d(
+            module.num_features, module.eps, module.momentum,
+            module.affine, module.track_running_stats
+        )
+        if module.affine:
+            module_output.weight = module.weight
+            module_output.bias = module.bias
+        module_output.running_mean = module.running_mean
+        module_output.running_var = module.running_var
+        module_output.num_batches_tracked = module.num_batches_tracked
+        module_output.training = module.training
+
+    for name, child in module.named_children():
+        module_output.add_module(name, convert_split_batchnorm(child))
+
+    return module_output
+
+
 def init_weights(net, init_type='normal', init_gain=0.02):
 
     def init_func(m):
@@ -45,3 +93,16 @@ def init_weights(net, init_type='normal', init_gain=0.02):
             init.constant_(m.bias.data, 0.0)
 
     net.apply(init_func)
+
+
+def downsample_pyramid(image, num_depths):
+    # image and its downsamples for each depth of MultiscaleDiscriminator
+
+    pyramid = [image]
+    for _ in range(num_depths - 1):
+        pyramid.append(F.interpolate(
+            pyramid[-1], scale_factor=0.5,
+            mode='bilinear', align_corners=True
+        ))
+
+    return pyramid
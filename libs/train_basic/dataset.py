@@ -1,31 +1,59 @@
-import os
+import torch
 import numpy as np
 import imageio.v2 as iio
 import albumentations as A
 import matplotlib.pyplot as plt
 
 from os.path import join as opj
-from ..utils import normalize_image
-from torch.utils.data import Dataset, DataLoader
+from ..utils import normalize_image, load_manifest, ShardStore, get_sample_cache
+from ..utils import build_pyramid, load_stream_index, ShardStreamDataset
+from ..utils import is_dist_avail_and_initialized
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
 
 
 class BCIBasicDataset(Dataset):
 
-    def __init__(self, data_dir, augment=False, norm_method='global_minmax'):
+    def __init__(self, data_dir, augment=False, norm_method='global_minmax',
+                 source='png', device_norm=False, cache_gb=0, cache_pool='train',
+                 pyramid=None, with_index=False):
         super(BCIBasicDataset, self).__init__()
 
+        assert source in ['png', 'shards', 'stream'], f'source {source} is invalid'
+        self.source = source
+
         he_dir  = opj(data_dir, 'HE')
         ihc_dir = opj(data_dir, 'IHC')
-        files   = os.listdir(he_dir)
+        if self.source == 'shards':
+            self.store = ShardStore(opj(data_dir, 'shards'))
+            files  = self.store.files
+            levels = self.store.levels
+            shape  = self.store.shape
+        elif self.source == 'stream':
+            # pairs are read by ShardStreamDataset, see process
+            index  = load_stream_index(opj(data_dir, 'stream'))
+            files  = [s['file'] for s in index['samples']]
+            levels = [s['level'] for s in index['samples']]
+            shape  = index['shape']
+        else:  # self.source == 'png'
+            samples = load_manifest(data_dir)
+            files  = [s['file'] for s in samples]
+            levels = [s['level'] for s in samples]
+            shape  = samples[0]['shape']
 
         self.he_list = []
         self.ihc_list = []
         self.level_list = []
 
-        for f in files:
+        for f, level in zip(files, levels):
             self.he_list.append(opj(he_dir, f))
             self.ihc_list.append(opj(ihc_dir, f))
-            self.level_list.append(int(f.split('_')[2][0]))
+            self.level_list.append(level)
+
+        self.cache = None
+        if (cache_gb > 0) and (self.source != 'stream'):
+            self.cache = get_sample_cache(
+                data_dir, self.source, len(files), shape, cache_gb, cache_pool
+            )
 
         self.augment = augment
         if self.augment:
@@ -48,17 +76,56 @@ class BCIBasicDataset(Dataset):
             )
 
         self.norm_method = norm_method
+        self.device_norm = device_norm
+        self.pyramid     = pyramid
+        self.with_index  = with_index
 
         return
 
     def __len__(self):
         return len(self.he_list)
 
+    def _get_pyramid(self, he, ihc):
+        # downsampled targets of normalized images in (c, h, w)
+
+        he  = torch.from_numpy(he)[None, ...]
+        ihc = torch.from_numpy(ihc)[None, ...]
+        pyramid = build_pyramid(he, ihc, self.pyramid)
+        pyramid = {k: v[0] for k, v in pyramid.items()}
+
+        return pyramid
+
+    def _read_pair(self, index):
+
+        if self.cache is not None:
+            pair = self.cache.get(index)
+            if pair is not None:
+                return pair
+
+        if self.source == 'shards':
+            he, ihc = self.store.read(index)
+        else:  # self.source == 'png'
+            he  = np.array(iio.imread(self.he_list[index]))
+            ihc = np.array(iio.imread(self.ihc_list[index]))
+
+        if self.cache is not None:
+            self.cache.put(index, he, ihc)
+
+        return he, ihc
+
     def __getitem__(self, index):
 
-        he    = np.array(iio.imread(self.he_list[index]))
-        ihc   = np.array(iio.imread(self.ihc_list[index]))
-        level = self.level_list[index]
+        he, ihc = self._read_pair(index)
+        level   = self.level_list[index]
+        sample  = self.process(he, ihc, level)
+
+        if self.with_index:
+            # index of sample is appended for latent cache of trainers
+            return (*sample, index)
+
+        return sample
+
+    def process(self, he, ihc, level):
 
         if self.augment:
             transformed = self.transform(image=he, image0=ihc)
@@ -85,36 +152,88 @@ class BCIBasicDataset(Dataset):
             # plt.tight_layout()
             # plt.show()
 
-        he  = normalize_image(he, 'he', self.norm_method)
-        he  = he.transpose(2, 0, 1).astype(np.float32)
-        ihc = normalize_image(ihc, 'ihc', self.norm_method)
-        ihc = ihc.transpose(2, 0, 1).astype(np.float32)
+        if self.device_norm:
+            # raw uint8 arrays in (h, w, c), normalized on device by trainers
+            he  = np.require(he,  np.uint8, ['C', 'W'])
+            ihc = np.require(ihc, np.uint8, ['C', 'W'])
+            return he, ihc, level
+
+        he  = normalize_image(he, 'he', self.norm_method, channels_first=True)
+        ihc = normalize_image(ihc, 'ihc', self.norm_method, channels_first=True)
+
+        if self.pyramid is not None:
+            return he, ihc, level, self._get_pyramid(he, ihc)
 
         return he, ihc, level
 
 
-def get_dataloader(mode, data_dir, configs):
-    assert mode in ['train', 'val']
+def get_dataloader(mode, data_dir, configs, pyramid=None, with_index=False,
+                   seed=0):
+    # latent mode reads training samples without augmentation,
+    # in which latents of real images are computed by frozen C
+    assert mode in ['train', 'val', 'latent']
 
     if mode == 'train':
         batch_size = configs.train_batch
         drop_last  = True
         shuffle    = True
-        augment    = True
+        augment    = configs.get('augment', 'cpu') == 'cpu'
+    elif mode == 'latent':
+        batch_size = configs.train_batch
+        drop_last  = False
+        shuffle    = False
+        augment    = False
+        pyramid    = None
+        with_index = True
     else:  # mode == 'val'
         batch_size = configs.val_batch
         drop_last  = False
         shuffle    = False
         augment    = False
+        pyramid    = None
 
+    # validation loader has its own budget of cache
+    if mode == 'val':
+        cache_gb, cache_pool = configs.get('val_cache_gb', 0), 'val'
+    else:
+        cache_gb, cache_pool = configs.get('cache_gb', 0), 'train'
+
+    source  = configs.get('source', 'png')
     dataset = BCIBasicDataset(
         data_dir=data_dir,
         augment=augment,
-        norm_method=configs.norm_method
+        norm_method=configs.norm_method,
+        source=source,
+        device_norm=configs.get('device_norm', False),
+        cache_gb=cache_gb,
+        cache_pool=cache_pool,
+        pyramid=pyramid,
+        with_index=with_index
     )
 
+    if source == 'stream':
+        # sequential reading of tar shards, shuffled in buffer
+        dataset = ShardStreamDataset(
+            stream_dir=opj(data_dir, 'stream'),
+            process=dataset.process,
+            shuffle=shuffle,
+            buffer_size=configs.get('shuffle_buffer', 64),
+            seed=seed,
+            with_index=with_index,
+            batch_size=batch_size,
+            drop_last=drop_last
+        )
+        shuffle = False
+
+    sampler = None
+    if (source != 'stream') and is_dist_avail_and_initialized():
+        # each process loads its own part of samples
+        sampler = DistributedSampler(dataset, shuffle=shuffle, drop_last=drop_last)
+        shuffle = False
+
     dataloader = DataLoader(
         dataset,
+        sampler=sampler,
         batch_size=batch_size,
         num_workers=configs.num_workers,
         pin_memory=configs.pin_memory,
@@ -1,4 +1,4 @@
-import os
+import torch
 import numpy as np
 import imageio.v2 as iio
 import albumentations as A
@@ -6,27 +6,55 @@ import albumentations as A
 
 from itertools import product
 from os.path import join as opj
-from ..utils import normalize_image
-from torch.utils.data import Dataset, DataLoader
+from ..utils import normalize_image, load_manifest, ShardStore, get_sample_cache
+from ..utils import build_pyramid, load_stream_index, ShardStreamDataset
+from ..utils import is_dist_avail_and_initialized
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
 
 
 class BCICAHRDataset(Dataset):
 
     def __init__(self, data_dir, mode, crop_size=512, random_crop=False,
-                 augment=False, norm_method='global_minmax'):
+                 augment=False, norm_method='global_minmax', source='png',
+                 device_norm=False, cache_gb=0, cache_pool='train', pyramid=None,
+                 with_index=False):
         super(BCICAHRDataset, self).__init__()
 
+        assert source in ['png', 'shards', 'stream'], f'source {source} is invalid'
+        self.source = source
+
         he_dir  = opj(data_dir, 'HE')
         ihc_dir = opj(data_dir, 'IHC')
-        files   = os.listdir(he_dir)
+        if self.source == 'shards':
+            self.store = ShardStore(opj(data_dir, 'shards'))
+            files  = self.store.files
+            levels = self.store.levels
+            shape  = self.store.shape
+        elif self.source == 'stream':
+            # pairs are read by ShardStreamDataset, see process
+            index  = load_stream_index(opj(data_dir, 'stream'))
+            files  = [s['file'] for s in index['samples']]
+            levels = [s['level'] for s in index['samples']]
+            shape  = index['shape']
+        else:  # self.source == 'png'
+            samples = load_manifest(data_dir)
+            files  = [s['file'] for s in samples]
+            levels = [s['level'] for s in samples]
+            shape  = samples[0]['shape']
 
         self.he_list = []
         self.ihc_list = []
         self.level_list = []
-        for f in files:
+        for f, level in zip(files, levels):
             self.he_list.append(opj(he_dir, f))
             self.ihc_list.append(opj(ihc_dir, f))
-            self.level_list.append(int(f.split('_')[2][0]))
+            self.level_list.append(level)
+
+        self.cache = None
+        if (cache_gb > 0) and (self.source != 'stream'):
+            self.cache = get_sample_cache(
+                data_dir, self.source, len(files), shape, cache_gb, cache_pool
+            )
 
         self.augment = augment
         if self.augment:
@@ -53,6 +81,9 @@ class BCICAHRDataset(Dataset):
         self.crop_size = crop_size
         self.random_crop = random_crop
         self.norm_method = norm_method
+        self.device_norm = device_norm
+        self.pyramid     = pyramid
+        self.with_index  = with_index
         self.crop_range  = self.full_size - self.crop_size
 
         if not self.random_crop:
@@ -81,15 +112,8 @@ class BCICAHRDataset(Dataset):
             row_idx = np.random.choice(self.crop_row_idxs)
             col_idx = np.random.choice(self.crop_col_idxs)
 
+        # crops are taken on device from full images by trainers
         crop_idx = np.array([row_idx, col_idx])
-        he_crop = he[
-            row_idx:row_idx + self.crop_size,
-            col_idx:col_idx + self.crop_size
-        ].copy()
-        ihc_crop = ihc[
-            row_idx:row_idx + self.crop_size,
-            col_idx:col_idx + self.crop_size
-        ].copy()
 
         # plt.figure(figsize=(15, 6))
         # plt.subplot(131)
@@ -100,86 +124,97 @@ class BCICAHRDataset(Dataset):
         # plt.title(f'IHC - {ihc.shape}')
         # plt.imshow(ihc)
         # plt.axis('off')
-        # plt.subplot(133)
-        # plt.title(f'HE Crop  - {he_crop.shape} - ({row_idx}, {col_idx})')
-        # plt.imshow(he_crop)
-        # plt.axis('off')
         # plt.tight_layout()
         # plt.show()
 
-        he  = normalize_image(he, 'he', self.norm_method)
-        he  = he.transpose(2, 0, 1).astype(np.float32)
-        ihc = normalize_image(ihc, 'ihc', self.norm_method)
-        ihc = ihc.transpose(2, 0, 1).astype(np.float32)
-        he_crop  = normalize_image(he_crop, 'he', self.norm_method)
-        he_crop  = he_crop.transpose(2, 0, 1).astype(np.float32)
-        ihc_crop = normalize_image(ihc_crop, 'ihc', self.norm_method)
-        ihc_crop = ihc_crop.transpose(2, 0, 1).astype(np.float32)
+        if self.device_norm:
+            # raw uint8 arrays in (h, w, c), normalized on device by trainers
+            he  = np.require(he,  np.uint8, ['C', 'W'])
+            ihc = np.require(ihc, np.uint8, ['C', 'W'])
+            return he, ihc, crop_idx
+
+        he  = normalize_image(he, 'he', self.norm_method, channels_first=True)
+        ihc = normalize_image(ihc, 'ihc', self.norm_method, channels_first=True)
 
-        return he, ihc, he_crop, ihc_crop, crop_idx
+        return he, ihc, crop_idx
 
     def _getitem_val(self, he, ihc):
 
-        he_crop_list = []
-        for row_idx, col_idx in self.crop_rowx_cols:
-            he_crop = he[
-                row_idx:row_idx + self.crop_size,
-                col_idx:col_idx + self.crop_size
-            ].copy()
-            he_crop_list.append(he_crop)
-        he_crop = np.array(he_crop_list)
+        # overlapping crops are taken on device from full image by trainers
+        crop_idx = np.array(self.crop_rowx_cols)
+        if self.device_norm:
+            # raw uint8 arrays in (h, w, c), normalized on device by trainers
+            he  = np.require(he,  np.uint8, ['C', 'W'])
+            ihc = np.require(ihc, np.uint8, ['C', 'W'])
+            return he, ihc, crop_idx
 
-        # print(he.shape, he_crop.shape)
+        he  = normalize_image(he, 'he', self.norm_method, channels_first=True)
+        ihc = normalize_image(ihc, 'ihc', self.norm_method, channels_first=True)
 
-        # plt.figure(figsize=(8, 8))
-        # plt.imshow(he[0])
-        # plt.axis('off')
-        # plt.tight_layout()
-        # plt.show()
+        return he, ihc, crop_idx
 
-        # plt.figure(figsize=(10, 10))
-        # for i in range(len(he_crop)):
-        #     image = he_crop[i]
-        #     row_idx, col_idx = self.crop_rowx_cols[i]
-        #     plt.subplot(3, 3, i + 1)
-        #     plt.title(f'IHC Crop {i + 1}- {image.shape} - ({row_idx}, {col_idx})')
-        #     plt.imshow(image)
-        #     plt.axis('off')
-        # plt.tight_layout()
-        # plt.show()
+    def _get_pyramid(self, he, ihc):
+        # downsampled targets of normalized images in (c, h, w)
 
-        he       = normalize_image(he, 'he', self.norm_method)
-        he       = he.transpose(2, 0, 1).astype(np.float32)
-        ihc      = normalize_image(ihc, 'ihc', self.norm_method)
-        ihc      = ihc.transpose(2, 0, 1).astype(np.float32)
-        he_crop  = normalize_image(he_crop, 'he', self.norm_method)
-        he_crop  = he_crop.transpose(0, 3, 1, 2).astype(np.float32)
-        crop_idx = np.array(self.crop_rowx_cols)
+        he  = torch.from_numpy(he)[None, ...]
+        ihc = torch.from_numpy(ihc)[None, ...]
+        pyramid = build_pyramid(he, ihc, self.pyramid)
+        pyramid = {k: v[0] for k, v in pyramid.items()}
+
+        return pyramid
+
+    def _read_pair(self, index):
+
+        if self.cache is not None:
+            pair = self.cache.get(index)
+            if pair is not None:
+                return pair
+
+        if self.source == 'shards':
+            he, ihc = self.store.read(index)
+        else:  # self.source == 'png'
+            he  = np.array(iio.imread(self.he_list[index]))
+            ihc = np.array(iio.imread(self.ihc_list[index]))
+
+        if self.cache is not None:
+            self.cache.put(index, he, ihc)
 
-        return he, ihc, he_crop, crop_idx
+        return he, ihc
 
     def __getitem__(self, index):
 
-        he    = np.array(iio.imread(self.he_list[index]))
-        ihc   = np.array(iio.imread(self.ihc_list[index]))
-        level = self.level_list[index]
+        he, ihc = self._read_pair(index)
+        level   = self.level_list[index]
+        sample  = self.process(he, ihc, level)
+
+        if self.with_index:
+            # index of sample is appended for latent cache of trainers
+            return (*sample, index)
+
+        return sample
+
+    def process(self, he, ihc, level):
 
         if self.mode == 'train':
-            he, ihc, he_crop, ihc_crop, crop_idx = self._getitem_train(he, ihc)
-            return he, ihc, level, he_crop, ihc_crop, crop_idx
+            he, ihc, crop_idx = self._getitem_train(he, ihc)
+            if self.pyramid is not None:
+                pyramid = self._get_pyramid(he, ihc)
+                return he, ihc, level, crop_idx, pyramid
+            return he, ihc, level, crop_idx
         else:  # self.mode == 'val'
-            he, ihc, he_crop, crop_idx = self._getitem_val(he, ihc)
-            return he, ihc, level, he_crop, crop_idx
+            he, ihc, crop_idx = self._getitem_val(he, ihc)
+            return he, ihc, level, crop_idx
 
 
-def get_cahr_dataloader(mode, data_dir, configs):
+def get_cahr_dataloader(mode, data_dir, configs, pyramid=None, with_index=False,
+                        seed=0):
     assert mode in ['train', 'val']
 
     if mode == 'train':
         batch_size  = configs.train_batch
         drop_last   = True
         shuffle     = True
-        augment     = True
+        augment     = configs.get('augment', 'cpu') == 'cpu'
         random_crop = configs.random_crop
     else:  # mode == 'val'
         assert configs.val_batch == 1
@@ -188,18 +223,53 @@ def get_cahr_dataloader(mode, data_dir, configs):
         shuffle     = False
         augment     = False
         random_crop = False
+        pyramid     = None
 
+    # validation loader has its own budget of cache
+    if mode == 'val':
+        cache_gb, cache_pool = configs.get('val_cache_gb', 0), 'val'
+    else:
+        cache_gb, cache_pool = configs.get('cache_gb', 0), 'train'
+
+    source  = configs.get('source', 'png')
     dataset = BCICAHRDataset(
         data_dir=data_dir,
         mode=mode,
         crop_size=configs.crop_size,
         random_crop=random_crop,
         augment=augment,
-        norm_method=configs.norm_method
+        norm_method=configs.norm_method,
+        source=source,
+        device_norm=configs.get('device_norm', False),
+        cache_gb=cache_gb,
+        cache_pool=cache_pool,
+        pyramid=pyramid,
+        with_index=with_index
     )
 
+    if source == 'stream':
+        # sequential reading of tar shards, shuffled in buffer
+        dataset = ShardStreamDataset(
+            stream_dir=opj(data_dir, 'stream'),
+            process=dataset.process,
+            shuffle=shuffle,
+            buffer_size=configs.get('shuffle_buffer', 64),
+            seed=seed,
+            with_index=with_index,
+            batch_size=batch_size,
+            drop_last=drop_last
+        )
+        shuffle = False
+
+    sampler = None
+    if (source != 'stream') and is_dist_avail_and_initialized():
+        # each process loads its own part of samples
+        sampler = DistributedSampler(dataset, shuffle=shuffle, drop_last=drop_last)
+        shuffle = False
+
     dataloader = DataLoader(
         dataset,
+        sampler=sampler,
         batch_size=batch_size,
         num_workers=configs.num_workers,
         pin_memory=configs.pin_memory,
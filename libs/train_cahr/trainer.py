@@ -12,23 +12,26 @@ class BCITrainerCAHR(BCIBaseTrainer):
         super(BCITrainerCAHR, self).__init__(configs, exp_dir, resume_ckpt)
         self.crop_loss  = self.configs.trainer.crop_loss
         self.infer_mode = self.configs.trainer.infer_mode
+        self.crop_size  = self.configs.loader.crop_size
 
-    def forward(self, train_loader, val_loader):
+    def forward(self, train_loader, val_loader, latent_loader=None):
 
         best_val_psnr = 0.0
         best_val_clsf = np.inf
         start_time = time.time()
 
         basic_msg = 'PSNR:{:.4f} SSIM:{:.4f} CLSF:{:.4f} Epoch:{}'
+        clsf_msg = None
         for epoch in range(self.start_epoch, self.epochs):
+            self._prepare_cmp(epoch, latent_loader)
             train_metrics = self._train_epoch(train_loader, epoch)
 
             # save model with best val psnr
-            val_model = self.Gema if self.ema else self.G
+            val_model = self.Gema.model_on(self.device) if self.ema else self.G
             val_metrics = self._val_epoch(val_model, val_loader, epoch)
             psnr = val_metrics['psnr']
             ssim = val_metrics['ssim']
-            clsf = val_metrics['clsf'] if self.apply_cmp else 0.0
+            clsf = val_metrics['clsf'] if self._C_ready() else 0.0
             info_list = [psnr, ssim, clsf, epoch]
 
             if psnr > best_val_psnr:
@@ -37,13 +40,16 @@ class BCITrainerCAHR(BCIBaseTrainer):
                 print('>>> Highest PSNR - Save Model <<<')
                 psnr_msg = '- Best PSNR: ' + basic_msg.format(*info_list)
 
-            if self.apply_cmp:
+            if self._C_ready():
                 if clsf < best_val_clsf:
                     best_val_clsf = clsf
                     self._save_model(val_model, 'best_clsf')
                     print('>>> Lowest  CLSF - Save Model <<<')
                     clsf_msg = '- Best CLSF: ' + basic_msg.format(*info_list)
 
+            # releases device copy of shadow G kept in cpu memory
+            del val_model
+
             # save checkpoint regularly
             if (epoch % self.ckpt_freq == 0) or (epoch + 1 == self.epochs):
                 self._save_checkpoint(epoch)
@@ -53,102 +59,148 @@ class BCITrainerCAHR(BCIBaseTrainer):
             print()
 
         print(psnr_msg)
-        if self.apply_cmp:
+        if clsf_msg is not None:
             print(clsf_msg)
 
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print('- Training time {}'.format(total_time_str))
+        self._close_writers()
 
         return
 
     def _train_epoch(self, loader, epoch):
         self.D.train()
         self.G.train()
+        self._freeze_bn(self.G, self.D)
 
         header = 'Train:[{}]'.format(epoch)
         logger = MetricLogger(header, self.print_freq)
         logger.add_meter('lr', SmoothedValue(1, '{value:.6f}'))
 
-        data_iter = logger.log_every(loader)
+        # seconds of stages of steps are written to log
+        timer = StageTimer(self.device)
+        self._set_epoch(loader, epoch)
+        prefetcher = DevicePrefetcher(loader, self.device)
+        data_iter = logger.log_every(prefetcher)
         for iter_step, data in enumerate(data_iter):
-            self.D_opt.zero_grad()
-            self.G_opt.zero_grad()
-
-            # lr scheduler on per iteration
+            # gradients are accumulated over micro-batches of accum_iter
+            # iterations, models are updated at the end of accumulation
             if iter_step % self.accum_iter == 0:
+                self._zero_grad()
+                # lr scheduler on per update
                 self._adjust_learning_rate(iter_step / len(loader) + epoch)
             logger.update(lr=self.G_opt.param_groups[0]['lr'])
+            self._log_step(epoch, iter_step)
 
             # forward
-            he, ihc, level, he_crop, ihc_crop, crop_idx = [d.to(self.device) for d in data]
-            outputs = self.G(he, he_crop, crop_idx, mode='train')
-            if not self.G.output_lowres:
-                ihc_phr, ihc_pcrop, he_plevel = outputs
-                ihc_plr = None
-            else:  # self.G.output_lowres is True
-                ihc_phr, ihc_plr, ihc_pcrop, he_plevel = outputs
-
-            # update C
-            if self.apply_cmp and (epoch < self.start_cmp):
-                self.C.train()
-                self._set_requires_grad(self.C, True)
-                ihc_plevel, ihc_platent = self.C(ihc)
-                lossC = self.ccl_loss(ihc_plevel, level)
-                logger.update(Cc=lossC.item())
-
-                lossC /= self.accum_iter
-                lossC.backward()
-                if (iter_step + 1) % self.accum_iter == 0:
-                    self.C_opt.step()
-
-            # update D
-            self._set_requires_grad(self.D, True)
-            Dfake, Dreal = self._D_loss(he, ihc, ihc_phr)
-            if self.crop_loss:
-                Dfake_crop, Dreal_crop = self._D_loss(he_crop, ihc_crop, ihc_pcrop)
-                Dfake += Dfake_crop
-                Dreal += Dreal_crop
-            logger.update(Df=Dfake.item(), Dr=Dreal.item())
-            lossD = (Dfake + Dreal) * 0.5
-
-            lossD /= self.accum_iter
-            lossD.backward()
-            if (iter_step + 1) % self.accum_iter == 0:
-                self.D_opt.step()
-
-            # update G
-            self._set_requires_grad(self.D, False)
-            Ggan, Grec, Gsim = self._G_loss(he, ihc, ihc_phr, ihc_plr)
-            if self.crop_loss:
-                Ggan_crop, Grec_crop, Gsim_crop = \
-                    self._G_loss(he_crop, ihc_crop, ihc_pcrop)
-                Ggan += Ggan_crop
-                Grec += Grec_crop
-                Gsim += Gsim_crop
-            Gcls = self.gcl_loss(he_plevel, level)
-            logger.update(Gg=Ggan.item(), Gr=Grec.item(),
-                          Gs=Gsim.item(), Gc=Gcls.item())
-            lossG = Ggan + Grec + Gsim + Gcls
-
-            if self.apply_cmp and (epoch >= self.start_cmp):
-                self.C.eval()
-                self._set_requires_grad(self.C, False)
-                Gcmp = self._C_loss(ihc, ihc_phr, level)
-                logger.update(Gm=Gcmp.item())
-                lossG += Gcmp
+            logger.update(wait=prefetcher.wait_time)
+            timer.add('wait', prefetcher.wait_time)
+            timer.add('h2d', prefetcher.copy_span)
+            index = None
+            if self.latent_cache:
+                data, index = data[:-1], data[-1]
+            he, ihc, level, crop_idx = data[:4]
+            pyramid = data[4] if len(data) > 4 else None
+            with timer('prep'):
+                he  = self._normalize(he, 'he')
+                ihc = self._normalize(ihc, 'ihc')
+                he, ihc = self._augment(he, ihc)
+                pyramid = self._get_pyramid(he, ihc, pyramid)
+
+            train_C = self.C_trained and (epoch < self.start_cmp)
+            micro_batches = self._micro_batches(he, ihc, level, crop_idx, pyramid, index)
+            for micro_step, (he, ihc, level, crop_idx, pyramid, index) in enumerate(micro_batches):
+                # gradients are synchronized in the last micro-batch
+                sync = ((iter_step + 1) % self.accum_iter == 0) and \
+                       (micro_step == len(micro_batches) - 1)
+                with self._no_sync(not sync):
+                    he_crop  = crop_images(he, crop_idx, self.crop_size)
+                    ihc_crop = crop_images(ihc, crop_idx, self.crop_size)
+                    with timer('G_fwd'), self._autocast():
+                        outputs = self.G(he, he_crop, crop_idx, mode='train')
+                    if not self.G.output_lowres:
+                        ihc_phr, ihc_pcrop, he_plevel = outputs
+                        ihc_plr = None
+                    else:  # self.G.output_lowres is True
+                        ihc_phr, ihc_plr, ihc_pcrop, he_plevel = outputs
+
+                    # update C
+                    if train_C:
+                        self.C.train()
+                        self._freeze_bn(self.C)
+                        self._set_requires_grad(self.C, True)
+                        with timer('C'), self._autocast():
+                            ihc_plevel, ihc_platent = self.C(ihc)
+                            lossC = self.ccl_loss(ihc_plevel, level)
+                        logger.update(Cc=lossC)
+
+                        lossC /= self.accum_steps
+                        with timer('C'):
+                            self.C_scaler.scale(lossC).backward()
+
+                    # update D
+                    self._set_requires_grad(self.D, True)
+                    with timer('D'), self._autocast():
+                        Dfake, Dreal = self._D_loss(he, ihc, ihc_phr, pyramid)
+                        if self.crop_loss:
+                            Dfake_crop, Dreal_crop = self._D_loss(he_crop, ihc_crop, ihc_pcrop)
+                            Dfake += Dfake_crop
+                            Dreal += Dreal_crop
+                    logger.update(Df=Dfake, Dr=Dreal)
+                    lossD = (Dfake + Dreal) * 0.5
+
+                    lossD /= self.accum_steps
+                    with timer('D'):
+                        self.D_scaler.scale(lossD).backward()
+
+                    # update G
+                    self._set_requires_grad(self.D, False)
+                    with timer('G_loss'), self._autocast():
+                        Ggan, Grec, Gsim = self._G_loss(he, ihc, ihc_phr, ihc_plr, pyramid)
+                        if self.crop_loss:
+                            Ggan_crop, Grec_crop, Gsim_crop = \
+                                self._G_loss(he_crop, ihc_crop, ihc_pcrop)
+                            Ggan += Ggan_crop
+                            Grec += Grec_crop
+                            Gsim += Gsim_crop
+                        Gcls = self.gcl_loss(he_plevel, level)
+                    logger.update(Gg=Ggan, Gr=Grec, Gs=Gsim, Gc=Gcls)
+                    lossG = Ggan + Grec + Gsim + Gcls
+
+                    if self.apply_cmp and (epoch >= self.start_cmp):
+                        self.C.eval()
+                        self._set_requires_grad(self.C, False)
+                        with timer('C'), self._autocast():
+                            Gcmp = self._C_loss(ihc, ihc_phr, level, index)
+                        logger.update(Gm=Gcmp)
+                        lossG += Gcmp
+
+                    lossG /= self.accum_steps
+                    with timer('G_bwd'):
+                        self.G_scaler.scale(lossG).backward()
 
-            lossG /= self.accum_iter
-            lossG.backward()
             if (iter_step + 1) % self.accum_iter == 0:
-                self.G_opt.step()
+                with timer('opt'):
+                    if train_C:
+                        self._step(self.C_opt, self.C_scaler)
+                    self._step(self.D_opt, self.D_scaler)
+                    self._step(self.G_opt, self.G_scaler)
                 if self.ema:
-                    self.Gema.update()
+                    with timer('ema'):
+                        self.Gema.update()
+
+            self.profiler.step()
 
+        self.profiler.stop()
+        logger.synchronize_between_processes()
         logger_info = {
             key: meter.global_avg
             for key, meter in logger.meters.items()
         }
+        logger_info.update(self._cache_stats(loader))
+        logger_info.update(self._memory_stats())
+        logger_info.update(timer.summary())
         return logger_info
 
     @torch.no_grad()
@@ -158,54 +210,81 @@ class BCITrainerCAHR(BCIBaseTrainer):
         header = ' Val :[{}]'.format(epoch)
         logger = MetricLogger(header, self.print_freq)
 
-        data_iter = logger.log_every(loader)
+        timer = StageTimer(self.device)
+        prefetcher = DevicePrefetcher(loader, self.device)
+        data_iter = logger.log_every(prefetcher)
         for _, data in enumerate(data_iter):
-            he, ihc, level, he_crop, crop_idx = [d.to(self.device) for d in data]
-            he_crop, crop_idx = he_crop[0], crop_idx[0]
-            outputs = self.G(he, he_crop, crop_idx, self.infer_mode)
+            logger.update(wait=prefetcher.wait_time)
+            timer.add('wait', prefetcher.wait_time)
+            timer.add('h2d', prefetcher.copy_span)
+            he, ihc, level, crop_idx = data
+            with timer('prep'):
+                he  = self._normalize(he, 'he')
+                ihc = self._normalize(ihc, 'ihc')
+            he_crop  = crop_grid(he, self.crop_size)
+            crop_idx = crop_idx[0]
+            with timer('G_fwd'), self._autocast():
+                outputs = self.G(he, he_crop, crop_idx, self.infer_mode)
             ihc_phr = outputs[0]
 
-            psnr, ssim = self.eval_metrics(ihc_phr, ihc)
-            logger.update(psnr=psnr.item(), ssim=ssim.item())
+            with timer('metric'):
+                psnr, ssim = self.eval_metrics(ihc_phr, ihc)
+            logger.update(psnr=psnr, ssim=ssim)
 
-            if self.apply_cmp:
+            if self._C_ready():
                 self.C.eval()
-                ihc_plevel, ihc_platent = self.C(ihc_phr)
-                clsf = self.ccl_loss(ihc_plevel, level)
-                logger.update(clsf=clsf.item())
+                with timer('C'), self._autocast():
+                    ihc_plevel, ihc_platent = self.C(ihc_phr)
+                    clsf = self.ccl_loss(ihc_plevel, level)
+                logger.update(clsf=clsf)
 
+        logger.synchronize_between_processes()
         logger_info = {
             key: meter.global_avg
             for key, meter in logger.meters.items()
         }
+        logger_info.update(self._cache_stats(loader))
+        logger_info.update(timer.summary())
         return logger_info
 
-    def _D_loss(self, he, ihc, ihc_phr):
+    def _D_loss(self, he, ihc, ihc_phr, pyramid=None):
 
         # fake
         fake = self._get_D_input(he, ihc_phr)
+        if self.d_batched:
+            # single forward of D for fake and real
+            real = self._get_D_input(he, ihc)
+            D_pyramid = self._get_D_pyramid(real, pyramid)
+            pfake, preal = self._D_forward_batched(fake.detach(), real, D_pyramid)
+            Dfake = self.gan_loss(pfake, False, for_D=True)
+            Dreal = self.gan_loss(preal, True, for_D=True)
+            return Dfake, Dreal
+
         pfake = self.D(fake.detach())
         Dfake = self.gan_loss(pfake, False, for_D=True)
 
         # real
         real = self._get_D_input(he, ihc)
-        preal = self.D(real)
+        preal = self._D_forward(real, self._get_D_pyramid(real, pyramid))
         Dreal = self.gan_loss(preal, True, for_D=True)
 
         return Dfake, Dreal
 
-    def _G_loss(self, he, ihc, ihc_phr, ihc_plr=None):
+    def _G_loss(self, he, ihc, ihc_phr, ihc_plr=None, pyramid=None):
 
-        # gan
+        # gan, D is frozen and not synchronized
         fake = self._get_D_input(he, ihc_phr)
-        pfake = self.D(fake)
+        pfake = unwrap_model(self.D)(fake)
         Ggan = self.gan_loss(pfake, True, for_D=False)
 
         # rec
         Grec = self.rec_loss(ihc_phr, ihc)
         if (ihc_plr is not None) and (self.low_weight > 0):
-            _, _, h, w = ihc_plr.size()
-            ihc_lr = F.interpolate(ihc, size=(h, w), mode='bilinear', align_corners=True)
+            if (pyramid is not None) and ('ihc_lr' in pyramid):
+                ihc_lr = pyramid['ihc_lr']
+            else:
+                _, _, h, w = ihc_plr.size()
+                ihc_lr = F.interpolate(ihc, size=(h, w), mode='bilinear', align_corners=True)
             Grec_lr = self.rec_loss(ihc_plr, ihc_lr)
             Grec += Grec_lr * self.low_weight
 
@@ -214,11 +293,17 @@ class BCITrainerCAHR(BCIBaseTrainer):
 
         return Ggan, Grec, Gsim
 
-    def _C_loss(self, ihc, ihc_phr, level):
+    def _C_loss(self, ihc, ihc_phr, level, index=None):
 
-        ihc_phr_plevel, ihc_phr_platent = self.C(ihc_phr)
+        # C is frozen and not synchronized
+        C = unwrap_model(self.C)
+        ihc_phr_plevel, ihc_phr_platent = C(ihc_phr)
         if self.cmp_loss.mode == 'csim':
-            ihc_plevel, ihc_platent = self.C(ihc)
+            if (index is not None) and (self.latents is not None):
+                # cached latents of real images without augmentation
+                ihc_platent = self.latents[index]
+            else:
+                ihc_plevel, ihc_platent = C(ihc)
             Gcmp = self.cmp_loss(ihc_phr_platent, ihc_platent.detach())
         else:  # self.cmp_loss.mode in ['ce', 'focal']
             Gcmp = self.cmp_loss(ihc_phr_plevel, level)
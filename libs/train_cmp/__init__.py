@@ -0,0 +1 @@
+from .trainer import *
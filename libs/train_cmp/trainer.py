@@ -0,0 +1,172 @@
+import os
+import time
+import torch
+import shutil
+import datetime
+
+from ..utils import *
+from ..models import define_C
+
+
+class BCITrainerCmp(BCIBaseTrainer):
+    # trains C alone for cmp loss of G, which can run ahead of G training
+    # or concurrently in another process, the best C is copied to
+    # model_C.pth in exp_dir at the end, which is loaded by trainers
+    # of G at start_cmp, settings of loader, amp, optimizer, checkpoints
+    # and logs are shared with trainers of G
+
+    def __init__(self, configs, exp_dir, resume_ckpt):
+
+        self._load_common(configs, exp_dir, resume_ckpt)
+
+        # C is trained for start_cmp epochs as in trainers of G
+        self.epochs = configs.trainer.get('cmp_epochs', configs.trainer.start_cmp)
+
+        # model
+        self.C_params = configs.C
+
+        self._load_model()
+        self._load_optimizer()
+        self._load_checkpoint()
+        self._load_distributed()
+        self._load_tracker()
+
+    def _load_model(self):
+
+        self.C = define_C(self.C_params)
+        self.C = self.C.to(self.device, memory_format=self.memory_format)
+        self.ccl_loss = ClsLoss(mode='focal', weight=1.0).to(self.device)
+
+        return
+
+    def _load_optimizer(self):
+
+        # same optimizer of C as in trainers of G
+        opt_func = self._opt_func()
+        self.C_opt = opt_func(self.C.parameters(), lr=1e-4, betas=(0.9, 0.99))
+        use_scaler = self.amp and (self.amp_dtype == torch.float16)
+        self.C_scaler = torch.amp.GradScaler(self.device, enabled=use_scaler)
+
+        return
+
+    def _load_state_dicts(self, checkpoint):
+
+        self.C.load_state_dict(checkpoint['C'])
+        self.C_opt.load_state_dict(checkpoint['C_opt'])
+        self.C_scaler.load_state_dict(checkpoint['C_scaler'])
+
+        return
+
+    def _net_names(self):
+        return ['C']
+
+    def _state_dicts(self):
+
+        return {
+            'C':        unwrap_model(self.C).state_dict(),
+            'C_opt':    self.C_opt.state_dict(),
+            'C_scaler': self.C_scaler.state_dict(),
+        }
+
+    def forward(self, train_loader, val_loader):
+        best_val_clsf = float('inf')
+        start_time = time.time()
+
+        basic_msg = 'CLSF:{:.4f} ACC:{:.4f} Epoch:{}'
+        clsf_msg = None
+        for epoch in range(self.start_epoch, self.epochs):
+            train_metrics = self._train_epoch(train_loader, epoch)
+            val_metrics = self._val_epoch(val_loader, epoch)
+            clsf = val_metrics['clsf']
+            info_list = [clsf, val_metrics['acc'], epoch]
+
+            if clsf < best_val_clsf:
+                best_val_clsf = clsf
+                self._save_model(self.C, 'best_clsf')
+                print('>>> Lowest  CLSF - Save Model <<<')
+                clsf_msg = '- Best CLSF: ' + basic_msg.format(*info_list)
+
+            if (epoch % self.ckpt_freq == 0) or (epoch + 1 == self.epochs):
+                self._save_checkpoint(epoch)
+
+            self._save_logs(epoch, train_metrics, val_metrics)
+
+        if clsf_msg is not None:
+            print(clsf_msg)
+        self.checkpointer.wait()
+        self._save_final_model()
+        self._close_writers()
+
+        total_time = time.time() - start_time
+        total_time_str = str(datetime.timedelta(seconds=int(total_time)))
+        print('- Training time {}'.format(total_time_str))
+
+        return
+
+    def _train_epoch(self, loader, epoch):
+        self.C.train()
+
+        header = 'Train:[{}]'.format(epoch)
+        logger = MetricLogger(header, self.print_freq)
+
+        self._set_epoch(loader, epoch)
+
+        prefetcher = DevicePrefetcher(loader, self.device)
+        data_iter = logger.log_every(prefetcher)
+        for _, data in enumerate(data_iter):
+            logger.update(wait=prefetcher.wait_time)
+            _, ihc, level = data[:3]
+            ihc = self._normalize(ihc, 'ihc')
+            ihc, = self._augment(ihc)
+
+            self.C_opt.zero_grad()
+            with self._autocast():
+                ihc_plevel, _ = self.C(ihc)
+                lossC = self.ccl_loss(ihc_plevel, level)
+            logger.update(Cc=lossC)
+
+            self.C_scaler.scale(lossC).backward()
+            self._step(self.C_opt, self.C_scaler)
+
+        logger.synchronize_between_processes()
+        return {key: meter.global_avg for key, meter in logger.meters.items()}
+
+    @torch.no_grad()
+    def _val_epoch(self, loader, epoch):
+        self.C.eval()
+
+        header = ' Val :[{}]'.format(epoch)
+        logger = MetricLogger(header, self.print_freq)
+
+        prefetcher = DevicePrefetcher(loader, self.device)
+        data_iter = logger.log_every(prefetcher)
+        for _, data in enumerate(data_iter):
+            logger.update(wait=prefetcher.wait_time)
+            _, ihc, level = data[:3]
+            ihc = self._normalize(ihc, 'ihc')
+            with self._autocast():
+                ihc_plevel, _ = self.C(ihc)
+            clsf = self.ccl_loss(ihc_plevel.float(), level)
+            acc = (ihc_plevel.argmax(dim=1) == level).float().mean()
+            logger.update(clsf=clsf, acc=acc)
+
+        logger.synchronize_between_processes()
+        return {key: meter.global_avg for key, meter in logger.meters.items()}
+
+    def _save_final_model(self):
+
+        if not is_main_process():
+            return
+
+        # renamed after copying, so that trainers of G waiting for
+        # model_C.pth never read a partial file
+        best_path  = os.path.join(self.exp_dir, 'model_best_clsf.pth')
+        final_path = os.path.join(self.exp_dir, 'model_C.pth')
+        if not os.path.isfile(best_path):
+            return
+
+        shutil.copyfile(best_path, final_path + '.tmp')
+        os.replace(final_path + '.tmp', final_path)
+        print(f'- Frozen C: {final_path}')
+
+        return
@@ -1,5 +1,16 @@
 from .utils import *
+from .dist import *
 from .losses import *
 from .logger import *
+from .manifest import *
+from .shards import *
+from .stream import *
+from .cache import *
+from .prefetch import *
+from .ema import *
+from .timer import *
+from .profiler import *
+from .tracker import *
+from .checkpoint import *
 from .base import BCIBaseTrainer
 from .diffaug import DiffAugment
@@ -0,0 +1,260 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugment(object):
+    # paired augmentation of a batch of images on device, which follows
+    # A.Compose in datasets: Flip, Transpose, RandomRotate90 are exact,
+    # RandomResizedCrop and one of Grid, Elastic, Optical distortions
+    # are merged into a single grid_sample with per-sample parameters
+
+    def __init__(self, flip_p=0.5, transpose_p=0.5, rotate_p=0.5,
+                 crop_p=0.2, crop_scale=(0.75, 1.0), crop_ratio=(3 / 4, 4 / 3),
+                 distort_p=0.3, grid_steps=5, grid_limit=0.3,
+                 elastic_alpha=1.0, elastic_sigma=50.0, elastic_affine=50.0,
+                 optical_limit=0.05):
+
+        self.flip_p         = flip_p
+        self.transpose_p    = transpose_p
+        self.rotate_p       = rotate_p
+        self.crop_p         = crop_p
+        self.crop_scale     = crop_scale
+        self.crop_ratio     = crop_ratio
+        self.distort_p      = distort_p
+        self.grid_steps     = grid_steps
+        self.grid_limit     = grid_limit
+        self.elastic_alpha  = elastic_alpha
+        self.elastic_sigma  = elastic_sigma
+        self.elastic_affine = elastic_affine
+        self.optical_limit  = optical_limit
+
+        return
+
+    def __call__(self, *images):
+        # images in (b, c, h, w), same transforms for all of them
+
+        sizes = [image.size(1) for image in images]
+        x = torch.cat(images, dim=1)
+        assert x.size(-2) == x.size(-1), 'only square images are supported'
+
+        x = self._dihedral(x)
+        x = self._resample(x)
+
+        return torch.split(x, sizes, dim=1)
+
+    @staticmethod
+    def _index(mask, device):
+        # random parameters are drawn on cpu, so no sync is needed here
+        index = mask.nonzero().view(-1)
+        if len(index) == 0:
+            return None
+        return index.to(device)
+
+    def _dihedral(self, x):
+
+        num = x.size(0)
+
+        # flip around x-axis, y-axis or both
+        flip = torch.rand(num) < self.flip_p
+        flip_code = torch.randint(0, 3, (num,))
+        for code, dims in enumerate([(-2,), (-1,), (-2, -1)]):
+            index = self._index(flip & (flip_code == code), x.device)
+            if index is not None:
+                x[index] = x[index].flip(dims)
+
+        index = self._index(torch.rand(num) < self.transpose_p, x.device)
+        if index is not None:
+            x[index] = x[index].transpose(-2, -1)
+
+        rotate = torch.rand(num) < self.rotate_p
+        rotate_k = torch.randint(0, 4, (num,))
+        for k in range(1, 4):
+            index = self._index(rotate & (rotate_k == k), x.device)
+            if index is not None:
+                x[index] = torch.rot90(x[index], k, dims=(-2, -1))
+
+        return x
+
+    def _resample(self, x):
+
+        num, _, height, width = x.size()
+        crop = torch.rand(num) < self.crop_p
+        # as A.OneOf, which always applies the chosen one of distortions
+        # of equal probabilities
+        distort = torch.rand(num) < self.distort_p
+        distort_type = torch.randint(0, 3, (num,))
+
+        index = self._index(crop | distort, x.device)
+        if index is None:
+            return x
+
+        device = x.device
+        selected = index.cpu()
+        crop, distort, distort_type = \
+            crop[selected], distort[selected], distort_type[selected]
+        num = len(selected)
+
+        # pixel coordinates in output, sampling positions are computed
+        # backward, from distortion in output to crop in input
+        u = torch.arange(width,  dtype=torch.float32, device=device).view(1, 1, -1)
+        v = torch.arange(height, dtype=torch.float32, device=device).view(1, -1, 1)
+        u = u.expand(num, height, width).clone()
+        v = v.expand(num, height, width).clone()
+
+        distort_fns = [self._grid_distort, self._elastic_distort, self._optical_distort]
+        for t, distort_fn in enumerate(distort_fns):
+            subset = self._index(distort & (distort_type == t), device)
+            if subset is not None:
+                u[subset], v[subset] = distort_fn(len(subset), height, width, device)
+
+        # random resized crop, identity for samples without crop
+        top, left, crop_h, crop_w = self._crop_params(num, height, width)
+        top    = torch.where(crop, top,    torch.zeros_like(top))
+        left   = torch.where(crop, left,   torch.zeros_like(left))
+        crop_h = torch.where(crop, crop_h, torch.full_like(crop_h, height))
+        crop_w = torch.where(crop, crop_w, torch.full_like(crop_w, width))
+        top, left, scale_h, scale_w = [
+            p.view(-1, 1, 1).to(device)
+            for p in [top, left, crop_h / height, crop_w / width]
+        ]
+        u = left + (u + 0.5) * scale_w - 0.5
+        v = top  + (v + 0.5) * scale_h - 0.5
+
+        grid = torch.stack([
+            (u + 0.5) / width  * 2.0 - 1.0,
+            (v + 0.5) / height * 2.0 - 1.0
+        ], dim=-1).to(x.dtype)
+
+        x[index] = F.grid_sample(
+            x[index], grid, mode='bilinear',
+            padding_mode='reflection', align_corners=False
+        )
+
+        return x
+
+    def _crop_params(self, num, height, width, attempts=10):
+        # first valid one of several attempts, whole image otherwise
+
+        area = height * width
+        scale = torch.empty(num, attempts).uniform_(*self.crop_scale)
+        log_ratio = torch.empty(num, attempts).uniform_(
+            math.log(self.crop_ratio[0]), math.log(self.crop_ratio[1])
+        )
+        ratio  = torch.exp(log_ratio)
+        crop_w = torch.round(torch.sqrt(area * scale * ratio))
+        crop_h = torch.round(torch.sqrt(area * scale / ratio))
+        valid  = (crop_w > 0) & (crop_w <= width) & (crop_h > 0) & (crop_h <= height)
+
+        first  = valid.int().argmax(dim=1, keepdim=True)
+        found  = valid.any(dim=1)
+        crop_w = torch.where(found, crop_w.gather(1, first)[:, 0], torch.tensor(float(width)))
+        crop_h = torch.where(found, crop_h.gather(1, first)[:, 0], torch.tensor(float(height)))
+
+        top  = torch.floor(torch.rand(num) * (height - crop_h + 1))
+        left = torch.floor(torch.rand(num) * (width  - crop_w + 1))
+
+        return top, left, crop_h, crop_w
+
+    def _grid_axis(self, num, size, device):
+        # piecewise linear mapping with random step lengths, the last
+        # knot is fixed at the border of image
+
+        step = size // self.grid_steps
+        knots = torch.arange(self.grid_steps + 1, dtype=torch.float32) * step
+        knots = torch.cat([knots, torch.tensor([float(size)])])
+
+        steps = torch.empty(num, self.grid_steps).uniform_(
+            1.0 - self.grid_limit, 1.0 + self.grid_limit
+        )
+        values = torch.cumsum(steps * step, dim=1)
+        values = torch.cat([
+            torch.zeros(num, 1), values, torch.full((num, 1), float(size))
+        ], dim=1)
+
+        coords = torch.arange(size, dtype=torch.float32)
+        seg = torch.bucketize(coords, knots, right=True) - 1
+        seg = seg.clamp(0, len(knots) - 2)
+        frac = (coords - knots[seg]) / (knots[seg + 1] - knots[seg])
+        mapped = values[:, seg] + frac * (values[:, seg + 1] - values[:, seg])
+
+        return mapped.to(device)
+
+    def _grid_distort(self, num, height, width, device):
+
+        u = self._grid_axis(num, width, device).view(num, 1, width)
+        v = self._grid_axis(num, height, device).view(num, height, 1)
+
+        return u.expand(num, height, width), v.expand(num, height, width)
+
+    def _smooth_noise(self, num, height, width, device):
+        # gaussian filtered uniform noise, filtered at low resolution
+        # and upsampled, amplitude is rescaled to match full resolution,
+        # low resolution is at least 16 pixels, and kernel is truncated
+        # to it, so that small images can be filtered too
+
+        factor = max(1, min(int(self.elastic_sigma // 4), min(height, width) // 16))
+        sigma  = self.elastic_sigma / factor
+        low_h, low_w = math.ceil(height / factor), math.ceil(width / factor)
+        radius = min(int(4 * sigma + 0.5), min(low_h, low_w) - 1)
+        kernel = torch.exp(-0.5 * (torch.arange(-radius, radius + 1) / sigma) ** 2)
+        kernel = (kernel / kernel.sum()).float()
+
+        noise = torch.rand(num * 2, 1, low_h, low_w) * 2.0 - 1.0
+        noise, kernel = noise.to(device), kernel.to(device)
+        pad = [radius, radius, 0, 0]
+        noise = F.conv2d(F.pad(noise, pad, mode='reflect'), kernel.view(1, 1, 1, -1))
+        pad = [0, 0, radius, radius]
+        noise = F.conv2d(F.pad(noise, pad, mode='reflect'), kernel.view(1, 1, -1, 1))
+        noise = F.interpolate(
+            noise, size=(height, width), mode='bilinear', align_corners=False
+        ) / factor
+
+        noise = noise.view(num, 2, height, width) * self.elastic_alpha
+        return noise[:, 0], noise[:, 1]
+
+    def _elastic_distort(self, num, height, width, device):
+
+        u = torch.arange(width,  dtype=torch.float32, device=device).view(1, 1, -1)
+        v = torch.arange(height, dtype=torch.float32, device=device).view(1, -1, 1)
+        du, dv = self._smooth_noise(num, height, width, device)
+        u, v = u + du, v + dv
+
+        # random affine by moving three points around center
+        center = torch.tensor([height // 2, width // 2], dtype=torch.float32)
+        square = min(height, width) // 3
+        src = torch.stack([
+            center + square,
+            torch.stack([center[0] + square, center[1] - square]),
+            center - square
+        ]).expand(num, 3, 2)
+        dst = src + torch.empty(num, 3, 2).uniform_(
+            -self.elastic_affine, self.elastic_affine
+        )
+
+        # inverse affine maps points in output to points in input
+        dst_h = torch.cat([dst, torch.ones(num, 3, 1)], dim=2)
+        inv_affine = torch.linalg.solve(dst_h, src)
+        inv_affine = inv_affine.view(num, 3, 1, 1, 2).to(device)
+        mapped = u[..., None] * inv_affine[:, 0] + \
+                 v[..., None] * inv_affine[:, 1] + inv_affine[:, 2]
+
+        return mapped[..., 0], mapped[..., 1]
+
+    def _optical_distort(self, num, height, width, device):
+        # barrel / pincushion distortion of camera model, the center
+        # is not shifted, as shifts in albumentations are rounded to 0
+
+        k = torch.empty(num, 1, 1).uniform_(-self.optical_limit, self.optical_limit)
+        k = k.to(device)
+        x = torch.arange(width,  dtype=torch.float32, device=device).view(1, 1, -1)
+        y = torch.arange(height, dtype=torch.float32, device=device).view(1, -1, 1)
+        x = (x - width * 0.5) / width
+        y = (y - height * 0.5) / height
+
+        r2 = x ** 2 + y ** 2
+        radial = 1.0 + k * r2 + k * r2 ** 2
+        u = x * radial * width  + width * 0.5
+        v = y * radial * height + height * 0.5
+
+        return u, v
@@ -1,40 +1,48 @@
 import os
-import json
 import math
+import time
 import torch
+import torch.nn as nn
+import contextlib
 
 from .losses import *
-from ema_pytorch import EMA
+from .norm import normalize_batch
+from .utils import build_pyramid
+from .augment import BatchAugment
+from .dist import DDP, unwrap_model, is_main_process, is_dist_avail_and_initialized
+from .dist import all_gather_cat
+from .prefetch import DevicePrefetcher
+from .compiler import setup_compile, compile_model
+from .profiler import StepProfiler, profile_regions
+from .tracker import build_tracker
+from .checkpoint import AsyncCheckpointer
+from .ema import ModelEMA
 from ..models import define_G, define_D, define_C
+from ..models import downsample_pyramid, convert_split_batchnorm, SplitBatchNorm2d
+from ..models.D import MultiscaleDiscriminator
 
 
 class BCIBaseTrainer(object):
 
     def __init__(self, configs, exp_dir, resume_ckpt):
 
-        self.configs  = configs
-        self.exp_dir  = exp_dir
-        self.ckpt_dir = os.path.join(self.exp_dir, 'ckpts')
-        os.makedirs(self.ckpt_dir, exist_ok=True)
-        self.log_path = os.path.join(self.exp_dir, 'log.txt')
-        self.resume_ckpt = resume_ckpt
+        self._load_common(configs, exp_dir, resume_ckpt)
 
         # trainer
-        self.start_epoch = 0
         self.epochs      = configs.trainer.epochs
-        self.ckpt_freq   = configs.trainer.ckpt_freq
-        self.print_freq  = configs.trainer.print_freq
         self.accum_iter  = configs.trainer.accum_iter
+        self.micro_batch = configs.trainer.get('micro_batch', 0)
+        self.micro_bn    = configs.trainer.get('micro_bn', 'micro')
         self.diffaug     = configs.trainer.diffaug
         self.ema         = configs.trainer.ema
         self.low_weight  = configs.trainer.low_weight
         self.apply_cmp   = configs.trainer.get('apply_cmp', False)
         self.start_cmp   = configs.trainer.get('start_cmp', 0)
+        self.d_batched   = configs.trainer.get('d_batched', False)
 
         # model
         self.D_params = configs.D
         self.G_params = configs.G
-        self.device   = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.D_input  = 'ihc' if configs.D.params.input_channels == 3 else 'he+ihc'
         if self.apply_cmp:
             self.C_params = configs.C
@@ -47,8 +55,34 @@ class BCIBaseTrainer(object):
         if self.apply_cmp:
             self.cmp_params = configs.loss.cmp
 
+        # latents of real ihc images by frozen C in csim mode, which are
+        # computed once without augmentation, see _load_latents, they
+        # differ from latents of augmented training samples, so they are
+        # only used if latent_unaugmented is set as well
+        self.latents = None
+        self.latent_cache = self.apply_cmp and \
+            configs.trainer.get('latent_cache', False) and \
+            (self.cmp_params.mode == 'csim')
+        if self.latent_cache and \
+           (not configs.trainer.get('latent_unaugmented', False)):
+            print('Warning: latent_cache is ignored, as training samples are '
+                  'augmented, set latent_unaugmented to use it')
+            self.latent_cache = False
+
+        # C trained by train_cmp.py, which is loaded at start_cmp
+        # instead of being trained in the first start_cmp epochs
+        self.C_loaded = False
+        self.pretrained_cmp = self.apply_cmp and \
+            configs.trainer.get('pretrained_cmp', False)
+        self.cmp_model = configs.trainer.get(
+            'cmp_model', os.path.join(exp_dir, 'cmp', 'model_C.pth')
+        )
+        self.cmp_timeout = configs.trainer.get('cmp_timeout', 86400)
+        # C is only trained here if it is not loaded, otherwise it has
+        # no optimizer and is not wrapped by DDP
+        self.C_trained = self.apply_cmp and (not self.pretrained_cmp)
+
         # optimizer
-        self.opt_name   = configs.optimizer.name
         self.opt_params = configs.optimizer.params
 
         # scheduler
@@ -56,29 +90,192 @@ class BCIBaseTrainer(object):
         self.warmup = configs.scheduler.warmup
 
         self._load_model()
+        self._load_micro_batch()
+        self._load_pyramid()
         self._load_losses()
         self._load_optimizer()
         self._load_checkpoint()
+        self._load_compile()
+        self._load_distributed()
+        self._load_profiler()
+        self._load_tracker()
+
+    def _load_common(self, configs, exp_dir, resume_ckpt):
+        # settings shared by trainers of G and C
+
+        self.configs  = configs
+        self.exp_dir  = exp_dir
+        self.ckpt_dir = os.path.join(self.exp_dir, 'ckpts')
+        os.makedirs(self.ckpt_dir, exist_ok=True)
+        self.log_path = os.path.join(self.exp_dir, 'log.txt')
+        self.resume_ckpt = resume_ckpt
+
+        # loader
+        self.norm_method = configs.loader.norm_method
+        self.device_norm = configs.loader.get('device_norm', False)
+        self.augment_on  = configs.loader.get('augment', 'cpu')
+        assert self.augment_on in ['cpu', 'device'], \
+            f'augment {self.augment_on} is invalid'
+        self.device_augment = self.augment_on == 'device'
+        if self.device_augment:
+            self.batch_augment = BatchAugment()
+
+        # trainer
+        self.start_epoch = 0
+        self.ckpt_freq   = configs.trainer.ckpt_freq
+        self.print_freq  = configs.trainer.print_freq
+
+        # checkpoints and models are saved in background, only the last
+        # keep_ckpts checkpoints are kept if it is positive
+        self.checkpointer = AsyncCheckpointer(configs.trainer.get('keep_ckpts', 0))
+
+        # models and batches are stored as (b, h, w, c) in channels last
+        self.channels_last = configs.trainer.get('channels_last', False)
+        self.memory_format = torch.channels_last if self.channels_last \
+                             else torch.contiguous_format
+
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+        # mixed precision, bf16 on cpu and fp16 with loss scaling on gpu
+        amp_params     = configs.get('amp', {})
+        self.amp       = amp_params.get('enabled', False)
+        amp_dtype      = amp_params.get('dtype', 'auto')
+        assert amp_dtype in ['auto', 'bf16', 'fp16'], \
+            f'amp dtype {amp_dtype} is invalid'
+        if amp_dtype == 'auto':
+            amp_dtype = 'fp16' if self.device == 'cuda' else 'bf16'
+        self.amp_dtype = torch.float16 if amp_dtype == 'fp16' else torch.bfloat16
+
+        # optimizer
+        self.opt_name = configs.optimizer.name
+
+        return
 
     def _load_model(self):
 
         self.D = define_D(self.D_params)
-        self.D = self.D.to(self.device)
+        self.D = self.D.to(self.device, memory_format=self.memory_format)
+        if self.d_batched:
+            # halves of real and fake batch are normalized separately
+            self.D = convert_split_batchnorm(self.D)
         self.G = define_G(self.G_params)
-        self.G = self.G.to(self.device)
+        self.G = self.G.to(self.device, memory_format=self.memory_format)
+
+        # activations of G stacks are recomputed in backward to save memory
+        checkpointing = self.configs.trainer.get('checkpointing', None)
+        if checkpointing is not None:
+            self.G.set_checkpointing(**checkpointing)
+            print(f'Activation checkpointing of G: {dict(checkpointing)}')
 
         if self.ema:
-            self.Gema = EMA(
+            # shadow of G is updated every ema_every steps, and is kept
+            # in pinned cpu memory if ema_device is cpu
+            self.Gema = ModelEMA(
                 self.G,
                 beta=0.99,
                 update_after_step=100,
-                update_every=1,
-                power=1.0
+                update_every=self.configs.trainer.get('ema_every', 1),
+                power=1.0,
+                device=self.configs.trainer.get('ema_device', None)
             )
 
         if self.apply_cmp:
             self.C = define_C(self.C_params)
-            self.C = self.C.to(self.device)
+            self.C = self.C.to(self.device, memory_format=self.memory_format)
+
+        return
+
+    def _load_profiler(self):
+
+        # training steps are profiled from the start if enabled in
+        # profile configs, or once the process gets the profile signal
+        self.profiler = StepProfiler(
+            self.configs.get('profile', {}),
+            os.path.join(self.exp_dir, 'profile'),
+            self.device, regions=self._profile_regions
+        )
+
+        return
+
+    def _load_tracker(self):
+
+        # logs of epochs are written by sinks of tracker configs in
+        # background, log.txt by default
+        self.tracker = None
+        if is_main_process():
+            self.tracker = build_tracker(
+                self.configs.get('tracker', {}), self.log_path, self.configs
+            )
+
+        return
+
+    def _profile_regions(self):
+
+        losses = {
+            'gan': self.gan_loss,
+            'rec': self.rec_loss,
+            'sim': self.sim_loss,
+            'gcl': self.gcl_loss
+        }
+        if self.apply_cmp:
+            losses['cmp'] = self.cmp_loss
+            losses['ccl'] = self.ccl_loss
+
+        return profile_regions(unwrap_model(self.G), unwrap_model(self.D), losses)
+
+    def _load_micro_batch(self):
+
+        # each loaded batch is split into micro-batches, and gradients
+        # are accumulated over micro-batches of accum_iter iterations
+        train_batch = self.configs.loader.train_batch
+        if (self.micro_batch <= 0) or (self.micro_batch >= train_batch):
+            self.micro_batch = train_batch
+        assert train_batch % self.micro_batch == 0, \
+            f'train_batch {train_batch} is not divisible by micro_batch {self.micro_batch}'
+        num_micro = train_batch // self.micro_batch
+        self.accum_steps = self.accum_iter * num_micro
+
+        # statistics of batch norm layers with micro-batches:
+        # - micro: normalized by, and running stats updated with micro-batches
+        # - momentum: as micro, but momentum of running stats is reduced,
+        #   so running stats move once per update as with full batches
+        # - frozen: normalized by running stats, which are not updated
+        assert self.micro_bn in ['micro', 'momentum', 'frozen'], \
+            f'micro_bn {self.micro_bn} is invalid'
+        if (self.micro_bn == 'momentum') and (self.accum_steps > 1):
+            nets = [self.G, self.D] + ([self.C] if self.apply_cmp else [])
+            for net in nets:
+                for m in net.modules():
+                    if isinstance(m, nn.modules.batchnorm._BatchNorm) and (m.momentum is not None):
+                        m.momentum = 1.0 - (1.0 - m.momentum) ** (1.0 / self.accum_steps)
+
+        return
+
+    def _load_pyramid(self):
+
+        # downsampled targets are delivered by loader, or built once
+        # per step on device if images are normalized or augmented there
+        self.pyramid = None
+        self.loader_pyramid = None
+        if not self.configs.loader.get('pyramid', False):
+            return
+
+        lowres_scale = 0
+        if self.G.output_lowres and (self.low_weight > 0):
+            lowres_scale = 2 ** len(self.G.encoder1)
+
+        depths = 1
+        if isinstance(self.D, MultiscaleDiscriminator) and (not self.diffaug):
+            # inputs of D are augmented differently in each pass
+            depths = self.D.num_depths
+
+        self.pyramid = {
+            'lowres_scale': lowres_scale,
+            'depths':       depths,
+            'with_he':      self.D_input == 'he+ihc'
+        }
+        if not (self.device_norm or self.device_augment):
+            self.loader_pyramid = self.pyramid
 
         return
 
@@ -97,7 +294,7 @@ class BCIBaseTrainer(object):
 
         return
 
-    def _load_optimizer(self):
+    def _opt_func(self):
 
         if self.opt_name == 'Adam':
             opt_func = torch.optim.Adam
@@ -108,11 +305,24 @@ class BCIBaseTrainer(object):
         else:
             raise ValueError('Unknown optimizer')
 
+        return opt_func
+
+    def _load_optimizer(self):
+
+        opt_func = self._opt_func()
         self.D_opt = opt_func(self.D.parameters(), **self.opt_params)
         self.G_opt = opt_func(self.G.parameters(), **self.opt_params)
-        if self.apply_cmp:
+        if self.C_trained:
             self.C_opt = opt_func(self.C.parameters(), lr=1e-4, betas=(0.9, 0.99))
 
+        # gradients of fp16 are scaled to avoid underflow, scalers
+        # are no-op if amp is disabled or in bf16
+        use_scaler = self.amp and (self.amp_dtype == torch.float16)
+        self.D_scaler = torch.amp.GradScaler(self.device, enabled=use_scaler)
+        self.G_scaler = torch.amp.GradScaler(self.device, enabled=use_scaler)
+        if self.C_trained:
+            self.C_scaler = torch.amp.GradScaler(self.device, enabled=use_scaler)
+
         return
 
     def _load_checkpoint(self):
@@ -138,59 +348,159 @@ class BCIBaseTrainer(object):
             print('Resume checkpoint from:', ckpt_path)
             checkpoint = torch.load(ckpt_path, map_location='cpu')
             self.start_epoch = checkpoint['epoch'] + 1
-            self.D.load_state_dict(checkpoint['D'])
-            self.G.load_state_dict(checkpoint['G'])
-            self.D_opt.load_state_dict(checkpoint['D_opt'])
-            self.G_opt.load_state_dict(checkpoint['G_opt'])
-            if self.ema:
-                self.Gema.load_state_dict(checkpoint['Gema'])
-            if self.apply_cmp:
-                self.C.load_state_dict(checkpoint['C'])
-                self.C_opt.load_state_dict(checkpoint['C_opt'])
-
+            self._load_state_dicts(checkpoint)
         except Exception:
             print('Faild to resume checkpoint')
 
         return
 
+    def _load_state_dicts(self, checkpoint):
+
+        self.D.load_state_dict(checkpoint['D'])
+        self.G.load_state_dict(checkpoint['G'])
+        self.D_opt.load_state_dict(checkpoint['D_opt'])
+        self.G_opt.load_state_dict(checkpoint['G_opt'])
+        if 'G_scaler' in checkpoint:
+            self.D_scaler.load_state_dict(checkpoint['D_scaler'])
+            self.G_scaler.load_state_dict(checkpoint['G_scaler'])
+        if self.ema:
+            self.Gema.load_state_dict(checkpoint['Gema'])
+        if self.C_trained:
+            self.C.load_state_dict(checkpoint['C'])
+            self.C_opt.load_state_dict(checkpoint['C_opt'])
+            if 'C_scaler' in checkpoint:
+                self.C_scaler.load_state_dict(checkpoint['C_scaler'])
+
+        return
+
+    def _load_compile(self):
+
+        compile_params = self.configs.get('compile', {})
+        if not compile_params.get('enabled', False):
+            return
+
+        setup_compile(
+            cache_dir=compile_params.get('cache_dir', None),
+            fallback=compile_params.get('fallback', True)
+        )
+
+        # models are compiled lazily in their first forward
+        net_names = compile_params.get('models', ['G', 'D', 'C'])
+        for net_name in net_names:
+            if (net_name == 'C') and (not self.apply_cmp):
+                continue
+            compile_model(
+                getattr(self, net_name), net_name,
+                mode=compile_params.get('mode', 'default'),
+                backend=compile_params.get('backend', 'inductor'),
+                dynamic=compile_params.get('dynamic', None)
+            )
+
+        return
+
+    def _load_distributed(self):
+
+        # models are wrapped after loading checkpoint, parameters of
+        # rank 0 are broadcasted to all processes by DDP
+        self.distributed = is_dist_avail_and_initialized()
+        if not self.distributed:
+            return
+
+        sync_bn = self.configs.trainer.get('sync_bn', False)
+        if sync_bn and (self.device != 'cuda'):
+            print('SyncBatchNorm is only supported on gpu, sync_bn is ignored')
+            sync_bn = False
+
+        for net_name in self._net_names():
+            net = getattr(self, net_name)
+            # SyncBatchNorm would mix statistics of real and fake halves
+            if sync_bn and not ((net_name == 'D') and self.d_batched):
+                net = nn.SyncBatchNorm.convert_sync_batchnorm(net)
+            device_ids = [torch.cuda.current_device()] if self.device == 'cuda' else None
+            setattr(self, net_name, DDP(net, device_ids=device_ids))
+
+        return
+
+    def _net_names(self):
+        return ['D', 'G'] + (['C'] if self.C_trained else [])
+
     def _save_checkpoint(self, epoch):
 
+        if not is_main_process():
+            return
+
         ckpt_file = f'ckpt-{epoch:06d}.pth'
         ckpt_path = os.path.join(self.ckpt_dir, ckpt_file)
 
-        ckpt = {
-            'epoch': epoch,
-            'D':     self.D.state_dict(),
-            'G':     self.G.state_dict(),
+        ckpt = {'epoch': epoch, **self._state_dicts()}
+        self.checkpointer.save(ckpt, ckpt_path, prune=True, pinned=True)
+
+        return
+
+    def _state_dicts(self):
+
+        state_dicts = {
+            'D':     unwrap_model(self.D).state_dict(),
+            'G':     unwrap_model(self.G).state_dict(),
             'D_opt': self.D_opt.state_dict(),
             'G_opt': self.G_opt.state_dict(),
+            'D_scaler': self.D_scaler.state_dict(),
+            'G_scaler': self.G_scaler.state_dict(),
         }
         if self.ema:
-            ckpt['Gema'] = self.Gema.state_dict()
-        if self.apply_cmp:
-            ckpt['C']     = self.C.state_dict()
-            ckpt['C_opt'] = self.C_opt.state_dict()
-
-        torch.save(ckpt, ckpt_path)
+            state_dicts['Gema'] = self.Gema.state_dict()
+        if self.C_trained:
+            state_dicts['C']     = unwrap_model(self.C).state_dict()
+            state_dicts['C_opt'] = self.C_opt.state_dict()
+            state_dicts['C_scaler'] = self.C_scaler.state_dict()
 
-        return
+        return state_dicts
 
     def _save_model(self, model, model_name):
 
+        if not is_main_process():
+            return
+
         model_path = os.path.join(self.exp_dir, f'model_{model_name}.pth')
-        torch.save(model.state_dict(), model_path)
+        self.checkpointer.save(unwrap_model(model).state_dict(), model_path)
 
         return
 
     def _save_logs(self, epoch, train_metrics, val_metrics):
 
+        if not is_main_process():
+            return
+
         log_stats = {
             **{f't{k}': round(v, 6) for k, v in train_metrics.items()},
             **{f'v{k}': round(v, 6) for k, v in val_metrics.items()},
             'epoch': epoch
         }
-        with open(self.log_path, mode='a', encoding='utf-8') as f:
-            f.write(json.dumps(log_stats) + '\n')
+        self.tracker.log(log_stats)
+
+        return
+
+    def _log_step(self, epoch, iter_step):
+
+        # learning rate of each step, only written by sinks of steps,
+        # such as wandb
+        if self.tracker is None:
+            return
+
+        self.tracker.log({
+            'iteration_step': iter_step,
+            'epoch':          epoch,
+            'learning_rate':  self.G_opt.param_groups[0]['lr']
+        }, kind='step')
+
+        return
+
+    def _close_writers(self):
+
+        # waits for queued logs and the last checkpoint to be written
+        self.checkpointer.wait()
+        if self.tracker is not None:
+            self.tracker.close()
 
         return
 
@@ -215,6 +525,276 @@ class BCIBaseTrainer(object):
 
         return
 
+    def _normalize(self, image, image_type):
+
+        # loaders return raw uint8 images in device_norm mode
+        if self.device_norm:
+            image = normalize_batch(
+                image, image_type, self.norm_method, self.channels_last
+            )
+
+        return image.contiguous(memory_format=self.memory_format)
+
+    def _zero_grad(self):
+
+        self.D_opt.zero_grad()
+        self.G_opt.zero_grad()
+        if self.C_trained:
+            self.C_opt.zero_grad()
+
+        return
+
+    def _micro_batches(self, *data):
+        # splits tensors and dicts of tensors of a batch into micro-batches
+
+        num_micro = self.accum_steps // self.accum_iter
+        if num_micro == 1:
+            return [data]
+
+        chunks = []
+        for d in data:
+            if d is None:
+                chunks.append([None] * num_micro)
+            elif isinstance(d, dict):
+                splits = {k: v.split(self.micro_batch) for k, v in d.items()}
+                chunks.append([{k: v[i] for k, v in splits.items()} for i in range(num_micro)])
+            else:
+                chunks.append(d.split(self.micro_batch))
+
+        return list(zip(*chunks))
+
+    def _freeze_bn(self, *nets):
+
+        if self.micro_bn != 'frozen':
+            return
+
+        for net in nets:
+            for m in net.modules():
+                if isinstance(m, nn.modules.batchnorm._BatchNorm):
+                    m.eval()
+
+        return
+
+    def _no_sync(self, no_sync=True):
+        # skips all-reduce of gradients for micro-batches before the last one
+
+        stack = contextlib.ExitStack()
+        if self.distributed and no_sync:
+            for net_name in self._net_names():
+                stack.enter_context(getattr(self, net_name).no_sync())
+
+        return stack
+
+    def _autocast(self):
+        return torch.autocast(self.device, dtype=self.amp_dtype, enabled=self.amp)
+
+    def _step(self, optimizer, scaler):
+        # optimizer step is skipped by scaler if gradients are not finite
+        scaler.step(optimizer)
+        scaler.update()
+        return
+
+    def _augment(self, *images):
+
+        # loaders skip augmentation if it is applied on device
+        if self.device_augment:
+            images = self.batch_augment(*images)
+            # splits of augmented batch are strided views
+            images = [image.contiguous(memory_format=self.memory_format)
+                      for image in images]
+
+        return images
+
+    def _get_pyramid(self, he, ihc, pyramid=None):
+
+        if (self.pyramid is not None) and (pyramid is None):
+            pyramid = build_pyramid(he, ihc, self.pyramid)
+        elif self.channels_last and (pyramid is not None):
+            # pyramid from loaders is in contiguous format
+            pyramid = {k: v.contiguous(memory_format=self.memory_format)
+                       for k, v in pyramid.items()}
+
+        return pyramid
+
+    def _get_D_pyramid(self, D_input, pyramid=None):
+        # inputs of all depths of D for real images
+
+        if (pyramid is None) or (self.pyramid['depths'] <= 1):
+            return None
+
+        D_pyramid = [D_input]
+        for depth in range(1, self.pyramid['depths']):
+            if self.D_input == 'he+ihc':
+                D_pyramid.append(torch.cat(
+                    (pyramid[f'he_{depth}'], pyramid[f'ihc_{depth}']), 1
+                ))
+            else:  # self.D_input == 'ihc'
+                D_pyramid.append(pyramid[f'ihc_{depth}'])
+
+        return D_pyramid
+
+    def _D_forward(self, D_input, D_pyramid=None):
+
+        if D_pyramid is None:
+            return self.D(D_input)
+
+        return self.D(D_input, D_pyramid)
+
+    def _C_ready(self):
+        # C predicts levels in validation once it is trained here, or
+        # loaded, a random C before start_cmp would select best_clsf
+        return self.apply_cmp and ((not self.pretrained_cmp) or self.C_loaded)
+
+    def _prepare_cmp(self, epoch, latent_loader=None):
+
+        # C is frozen from start_cmp
+        if (not self.apply_cmp) or (epoch < self.start_cmp):
+            return
+
+        if self.pretrained_cmp:
+            self._load_pretrained_C()
+        if self.latent_cache:
+            self._load_latents(latent_loader)
+
+        return
+
+    def _load_pretrained_C(self):
+        # waits for C if train_cmp.py is still running in another process
+
+        if self.C_loaded:
+            return
+
+        # raises after cmp_timeout seconds, such as if train_cmp.py failed
+        if not os.path.isfile(self.cmp_model):
+            print(f'Wait for C: {self.cmp_model}')
+        start = time.time()
+        while not os.path.isfile(self.cmp_model):
+            waited = time.time() - start
+            if waited >= self.cmp_timeout:
+                raise TimeoutError(
+                    f'{self.cmp_model} is not found after {waited:.0f}s, '
+                    'check train_cmp.py or increase cmp_timeout'
+                )
+            time.sleep(min(30, self.cmp_timeout - waited))
+
+        C_dict = torch.load(self.cmp_model, map_location='cpu')
+        unwrap_model(self.C).load_state_dict(C_dict)
+        self.C_loaded = True
+        print(f'Load frozen C: {self.cmp_model}')
+
+        return
+
+    @torch.no_grad()
+    def _load_latents(self, loader):
+        # latents of real ihc images are computed once C is frozen, and
+        # saved next to checkpoints for resuming
+
+        if self.latents is not None:
+            return
+
+        latents_path = os.path.join(self.ckpt_dir, 'latents.pth')
+        if (self.start_epoch > self.start_cmp) and os.path.isfile(latents_path):
+            self.latents = torch.load(latents_path, map_location=self.device)
+            print(f'Load latents of {len(self.latents)} samples: {latents_path}')
+            return
+
+        C = unwrap_model(self.C)
+        C.eval()
+
+        indices, latents = [], []
+        for data in DevicePrefetcher(loader, self.device):
+            ihc, index = data[1], data[-1]
+            ihc = self._normalize(ihc, 'ihc')
+            with self._autocast():
+                _, latent = C(ihc)
+            indices.append(index)
+            latents.append(latent.float())
+
+        # each process computes latents of its own part of samples
+        indices = all_gather_cat(torch.cat(indices))
+        latents = all_gather_cat(torch.cat(latents))
+        self.latents = latents.new_zeros(int(indices.max()) + 1, latents.size(1))
+        self.latents[indices] = latents
+
+        if is_main_process():
+            self.checkpointer.save(self.latents, latents_path)
+        print(f'Save latents of {len(self.latents)} samples: {latents_path}')
+
+        return
+
+    def _D_forward_batched(self, fake, real, D_pyramid=None):
+        # fake and real inputs are concatenated along batch for a single
+        # forward of D, predictions are split into fake and real halves
+
+        num = fake.size(0)
+        D_input = torch.cat((fake, real), 0)
+        if D_pyramid is not None:
+            fake_pyramid = downsample_pyramid(fake, len(D_pyramid))
+            D_pyramid = [D_input] + [
+                torch.cat(inputs, 0)
+                for inputs in zip(fake_pyramid[1:], D_pyramid[1:])
+            ]
+
+        with self._split_bn(self.D, 2):
+            preds = self._D_forward(D_input, D_pyramid)
+
+        if torch.is_tensor(preds):
+            return preds[:num], preds[num:]
+
+        pfake = [[pred[:num] for pred in preds_] for preds_ in preds]
+        preal = [[pred[num:] for pred in preds_] for preds_ in preds]
+        return pfake, preal
+
+    @contextlib.contextmanager
+    def _split_bn(self, net, num_splits):
+
+        bns = [m for m in net.modules() if isinstance(m, SplitBatchNorm2d)]
+        for m in bns:
+            m.num_splits = num_splits
+        try:
+            yield
+        finally:
+            for m in bns:
+                m.num_splits = 1
+
+    def _set_epoch(self, loader, epoch):
+
+        # shuffles samples of distributed sampler in each epoch
+        if hasattr(loader.sampler, 'set_epoch'):
+            loader.sampler.set_epoch(epoch)
+
+        # shuffles shards of streaming datasets in each epoch, and skips
+        # shards already trained in the resumed epoch
+        if hasattr(loader.dataset, 'set_epoch'):
+            start_shard = 0
+            if epoch == self.start_epoch:
+                start_shard = self.configs.loader.get('start_shard', 0)
+            loader.dataset.set_epoch(epoch, start_shard)
+
+        return
+
+    def _cache_stats(self, loader):
+
+        # hits and misses of sample cache in the last epoch
+        cache = getattr(loader.dataset, 'cache', None)
+        if cache is None:
+            return {}
+
+        return cache.pop_stats()
+
+    def _memory_stats(self):
+
+        # peak memory allocated on gpu since the last call, which is
+        # compared between runs with and without activation checkpointing
+        if self.device != 'cuda':
+            return {}
+
+        peak = torch.cuda.max_memory_allocated() / 1024 ** 3
+        torch.cuda.reset_peak_memory_stats()
+        print(f'- Peak memory: {peak:.3f}GB')
+
+        return {'mem': peak}
+
     def _set_requires_grad(self, nets, requires_grad=False):
 
         if not isinstance(nets, list):
@@ -0,0 +1,126 @@
+import os
+import torch
+import numpy as np
+import torch.multiprocessing as mp
+
+
+# caches of data directories in this process, see get_sample_cache
+SAMPLE_CACHES = {}
+
+
+class SharedSampleCache(object):
+    # decoded HE/IHC pairs kept in shared memory, so that all workers
+    # of DataLoader read and fill the same slots across epochs
+
+    def __init__(self, num_samples, shape, cache_gb):
+
+        self.shape = tuple(shape)
+        slot_bytes = 2 * int(np.prod(self.shape))
+        num_slots  = min(int(cache_gb * 1024 ** 3) // slot_bytes, num_samples)
+        assert num_slots > 0, \
+            f'cache_gb {cache_gb} is too small for one pair of {self.shape}'
+        self.num_slots = num_slots
+
+        # slots of pairs, and sample index / last access tick of each slot
+        self.slots      = torch.empty((num_slots, 2, *self.shape), dtype=torch.uint8)
+        self.slot_keys  = torch.full((num_slots,), -1, dtype=torch.int64)
+        self.slot_ticks = torch.full((num_slots,), -1, dtype=torch.int64)
+        # slot of each sample, -1 if not cached
+        self.key_slots  = torch.full((num_samples,), -1, dtype=torch.int64)
+        # hits, misses and global tick
+        self.counters   = torch.zeros(3, dtype=torch.int64)
+
+        for tensor in [self.slots, self.slot_keys, self.slot_ticks,
+                       self.key_slots, self.counters]:
+            tensor.share_memory_()
+
+        self.lock = mp.Lock()
+        size_gb = self.slots.numel() / 1024 ** 3
+        print(f'- Sample cache: {num_slots} slots, {size_gb:.2f} GB')
+
+        return
+
+    def _touch(self, slot):
+        self.counters[2] += 1
+        self.slot_ticks[slot] = self.counters[2]
+        return
+
+    def get(self, key):
+        # returns copies of cached pair, or None if key is not cached
+
+        with self.lock:
+            slot = int(self.key_slots[key])
+            if slot < 0:
+                self.counters[1] += 1
+                return None
+
+            self.counters[0] += 1
+            self._touch(slot)
+            # copy under lock since the slot can be evicted by other workers
+            pair = self.slots[slot].numpy().copy()
+
+        return pair[0], pair[1]
+
+    def put(self, key, he, ihc):
+
+        if (he.shape != self.shape) or (ihc.shape != self.shape):
+            return
+
+        with self.lock:
+            if self.key_slots[key] >= 0:
+                return
+
+            # empty slots have tick -1, so they are filled first,
+            # otherwise the least recently used slot is evicted
+            slot = int(torch.argmin(self.slot_ticks))
+            evicted = int(self.slot_keys[slot])
+            if evicted >= 0:
+                self.key_slots[evicted] = -1
+
+            slot_array = self.slots[slot].numpy()
+            slot_array[0] = he
+            slot_array[1] = ihc
+            self.slot_keys[slot] = key
+            self.key_slots[key]  = slot
+            self._touch(slot)
+
+        return
+
+    def pop_stats(self):
+        # returns hits and misses since last call
+
+        with self.lock:
+            stats = {
+                'cache_hits':   int(self.counters[0]),
+                'cache_misses': int(self.counters[1])
+            }
+            self.counters[:2] = 0
+
+        return stats
+
+
+def get_sample_cache(data_dir, source, num_samples, shape, cache_gb, pool='train'):
+    # caches are shared by loaders of the same data directory, such as
+    # training and latent loaders, and all caches of the same pool of this
+    # process take cache_gb in total, in order of creation, the validation
+    # loader uses its own pool, so that it never starves for training,
+    # a loader has no cache if the memory left is not enough for one pair
+
+    key = (os.path.abspath(data_dir), source)
+    if key in SAMPLE_CACHES:
+        cache = SAMPLE_CACHES[key]
+        assert cache.key_slots.numel() == num_samples, \
+            f'cache of {data_dir} has {cache.key_slots.numel()} samples'
+        return cache
+
+    used_bytes = sum(c.slots.numel() for c in SAMPLE_CACHES.values() if c.pool == pool)
+    free_bytes = int(cache_gb * 1024 ** 3) - used_bytes
+    if free_bytes < 2 * int(np.prod(shape)):
+        print(f'- Sample cache: no memory left of {cache_gb} GB for {data_dir}')
+        return None
+
+    cache = SharedSampleCache(num_samples, shape, free_bytes / 1024 ** 3)
+    cache.pool = pool
+    SAMPLE_CACHES[key] = cache
+
+    return cache
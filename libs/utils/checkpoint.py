@@ -0,0 +1,110 @@
+import os
+import glob
+import torch
+import threading
+
+
+class AsyncCheckpointer(object):
+    # saves state dicts in a background thread, tensors are copied to cpu
+    # before save returns, so that training can go on updating models,
+    # files are written to temporary paths and renamed, so that they are
+    # never partial, save waits only if the previous save is in flight,
+    # and only the last keep_ckpts checkpoints are kept if it is positive,
+    # errors of the background write are raised by wait or the next save
+
+    def __init__(self, keep_ckpts=0):
+
+        self.keep_ckpts = keep_ckpts
+        self.worker = None
+        self.error = None
+        # pinned buffers reused by states saved with pinned=True
+        self.buffers = {}
+
+        return
+
+    def save(self, state, path, prune=False, pinned=False):
+
+        self.wait()
+        state = snapshot(state, self.buffers if pinned else None)
+        self.worker = threading.Thread(
+            target=self._write, args=(state, path, prune), daemon=True
+        )
+        self.worker.start()
+
+        return
+
+    def wait(self):
+
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+        return
+
+    def _write(self, state, path, prune):
+
+        dirname, basename = os.path.split(path)
+        tmp_path = os.path.join(dirname, f'.{basename}.tmp')
+        try:
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self.error = e
+            return
+
+        if prune and (self.keep_ckpts > 0):
+            # checkpoints are named by zero padded epochs
+            ckpt_paths = sorted(glob.glob(os.path.join(dirname, 'ckpt-*.pth')))
+            try:
+                for ckpt_path in ckpt_paths[:-self.keep_ckpts]:
+                    os.remove(ckpt_path)
+            except Exception as e:
+                self.error = e
+
+        return
+
+
+def snapshot(state, buffers=None):
+    # copies tensors in nested state to cpu, if buffers is given, cuda
+    # tensors are copied without blocking to pinned buffers which are
+    # kept in buffers by their keys and reused by later snapshots, and
+    # synchronized once at the end, otherwise they are copied to pageable
+    # memory, which is enough for rarely saved states
+
+    has_cuda = [False]
+
+    def copy(obj, key):
+        if isinstance(obj, torch.Tensor):
+            obj = obj.detach()
+            if not obj.is_cuda:
+                return obj.clone()
+            if buffers is None:
+                return obj.to('cpu')
+            out = buffers.get(key)
+            if (out is None) or (out.shape != obj.shape) or (out.dtype != obj.dtype):
+                out = torch.empty_like(obj, device='cpu', pin_memory=True)
+                buffers[key] = out
+            has_cuda[0] = True
+            return out.copy_(obj, non_blocking=True)
+        elif isinstance(obj, dict):
+            out = type(obj)((k, copy(v, key + (k,))) for k, v in obj.items())
+            if hasattr(obj, '_metadata'):
+                # versions of modules in state dict
+                out._metadata = obj._metadata
+            return out
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(copy(v, key + (i,)) for i, v in enumerate(obj))
+        else:
+            return obj
+
+    state = copy(state, ())
+    if has_cuda[0]:
+        torch.cuda.synchronize()
+
+    return state
@@ -0,0 +1,30 @@
+import os
+import torch
+
+
+COMPILE_MODES = ['default', 'reduce-overhead', 'max-autotune', 'max-autotune-no-cudagraphs']
+
+
+def setup_compile(cache_dir=None, fallback=True):
+    # compiled graphs are cached in cache_dir and reused by later runs,
+    # frames failed to compile run in eager mode with a logged warning
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+    torch._inductor.config.fx_graph_cache = True
+    torch._dynamo.config.suppress_errors = fallback
+
+    return
+
+
+def compile_model(model, name, mode='default', backend='inductor', dynamic=None):
+    # compiles in place, attributes and keys of state dict are unchanged,
+    # compilation is lazy, in the first forward, so errors are not raised
+    # here, frames failed to compile fall back to eager mode by setup_compile
+
+    assert mode in COMPILE_MODES, f'compile mode {mode} is invalid'
+    model.compile(mode=mode, backend=backend, dynamic=dynamic)
+    print(f'Compile {name} with {backend} in {mode} mode')
+
+    return model
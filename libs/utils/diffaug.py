@@ -6,6 +6,8 @@ import torch
 import warnings
 import torch.nn.functional as F
 
+from .utils import get_memory_format
+
 
 warnings.filterwarnings('ignore')
 
@@ -14,6 +16,8 @@ def DiffAugment(x, policy=['rotation', 'cutout'],
                 channels_first=True):
 
     if policy:
+        # outputs are in the same memory format as inputs
+        memory_format = get_memory_format(x)
         if not channels_first:
             x = x.permute(0, 3, 1, 2)
         for p in policy:
@@ -21,7 +25,7 @@ def DiffAugment(x, policy=['rotation', 'cutout'],
                 x = f(x)
         if not channels_first:
             x = x.permute(0, 2, 3, 1)
-        x = x.contiguous()
+        x = x.contiguous(memory_format=memory_format)
     return x
 
 
@@ -0,0 +1,115 @@
+import os
+import torch
+import builtins
+import datetime
+import torch.distributed as dist
+
+from torch.nn.parallel import DistributedDataParallel
+
+
+def is_dist_avail_and_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_world_size():
+    if not is_dist_avail_and_initialized():
+        return 1
+    return dist.get_world_size()
+
+
+def get_rank():
+    if not is_dist_avail_and_initialized():
+        return 0
+    return dist.get_rank()
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def setup_for_distributed(is_master):
+    # disables printing when not in master process,
+    # use print(..., force=True) to print in all processes
+
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_master or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+    return
+
+
+def init_distributed_mode(args):
+    # processes are started by torchrun, which sets RANK, WORLD_SIZE
+    # and LOCAL_RANK, nccl is used on gpu and gloo on cpu
+
+    if args.launcher == 'none':
+        args.distributed = False
+        return
+
+    args.rank       = int(os.environ['RANK'])
+    args.world_size = int(os.environ['WORLD_SIZE'])
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.distributed = True
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(args.local_rank)
+        backend = 'nccl'
+    else:
+        backend = 'gloo'
+
+    print(f'| distributed init (rank {args.rank}): {backend}', flush=True)
+    dist.init_process_group(
+        backend=backend, init_method='env://',
+        world_size=args.world_size, rank=args.rank,
+        timeout=datetime.timedelta(minutes=30)
+    )
+    dist.barrier()
+    setup_for_distributed(args.rank == 0)
+
+    return
+
+
+def all_reduce_sum(values):
+    # sums a list of numbers over all processes
+
+    if not is_dist_avail_and_initialized():
+        return values
+
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    t = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(t)
+
+    return t.tolist()
+
+
+def all_gather_cat(tensor):
+    # concatenates tensors of different lengths from all processes
+
+    if not is_dist_avail_and_initialized():
+        return tensor
+
+    tensors = [None] * get_world_size()
+    dist.all_gather_object(tensors, tensor.cpu())
+
+    return torch.cat(tensors).to(tensor.device)
+
+
+class DDP(DistributedDataParallel):
+    # attributes of wrapped model, such as G.output_lowres,
+    # are accessible from the wrapper
+
+    def __getattr__(self, name):
+        try:
+            return super(DDP, self).__getattr__(name)
+        except AttributeError:
+            return getattr(self.module, name)
+
+
+def unwrap_model(model):
+    if isinstance(model, DistributedDataParallel):
+        return model.module
+    return model
@@ -0,0 +1,165 @@
+import copy
+import torch
+
+
+class ModelEMA(object):
+    # exponential moving average of weights of model, parameters and float
+    # buffers are averaged with fused foreach ops, other buffers are copied,
+    # the shadow model is updated once every update_every steps, and can be
+    # kept in pinned cpu memory, where the update is applied asynchronously:
+    # weights are copied to host in the stream of training, and averaged on
+    # host at the next update, once the copy is done
+
+    def __init__(
+        self, model, beta=0.99, update_after_step=100,
+        update_every=1, power=1.0, device=None
+    ):
+
+        self.model             = model
+        self.beta              = beta
+        self.update_after_step = update_after_step
+        self.update_every      = update_every
+        self.power             = power
+        self.step              = 0
+
+        self.module = copy.deepcopy(model).eval()
+        self.module.requires_grad_(False)
+
+        # shadow weights are offloaded only if device differs from model
+        model_device = next(model.parameters()).device
+        self.device  = torch.device(device) if device is not None else model_device
+        self.offload = self.device != model_device
+        self.pending = None
+        if self.offload:
+            self.module.to(self.device)
+            for tensor in self._tensors(self.module):
+                tensor.data = tensor.data.pin_memory()
+            self.staging = [
+                torch.empty_like(t, device=self.device).pin_memory()
+                for t in self._tensors(self.module)
+            ]
+
+        return
+
+    @staticmethod
+    def _tensors(model):
+        return [p.data for p in model.parameters()] + \
+               [b.data for b in model.buffers()]
+
+    def _get_decay(self):
+
+        # number of averaged updates, decay is warmed up as in ema-pytorch,
+        # which is the bias-corrected running mean of weights when power is
+        # 1, and then clamped by beta compounded over update interval
+        updates = (self.step - self.update_after_step) // self.update_every - 1
+        if updates <= 0:
+            return 0.0
+
+        decay = 1 - (1 + updates) ** -self.power
+        return min(decay, self.beta ** self.update_every)
+
+    @torch.no_grad()
+    def update(self):
+
+        self.step += 1
+        if self.step % self.update_every != 0:
+            return
+
+        # shadow follows model until update_after_step
+        decay = 0.0 if self.step <= self.update_after_step else self._get_decay()
+        online = self._tensors(self.model)
+
+        if self.offload:
+            self.synchronize()
+            for stage, tensor in zip(self.staging, online):
+                stage.copy_(tensor, non_blocking=True)
+            event = None
+            if online[0].is_cuda:
+                event = torch.cuda.Event()
+                event.record()
+            self.pending = (decay, event)
+        else:
+            self._average(self._tensors(self.module), online, decay)
+
+        return
+
+    @torch.no_grad()
+    def synchronize(self):
+
+        # applies update pending on host copies of weights
+        if self.pending is None:
+            return
+
+        decay, event = self.pending
+        if event is not None:
+            event.synchronize()
+        self._average(self._tensors(self.module), self.staging, decay)
+        self.pending = None
+
+        return
+
+    @staticmethod
+    def _average(shadow, online, decay):
+
+        floats = [i for i, t in enumerate(shadow) if t.is_floating_point()]
+        others = [i for i, t in enumerate(shadow) if not t.is_floating_point()]
+
+        shadow_floats = [shadow[i] for i in floats]
+        online_floats = [online[i] for i in floats]
+        if decay == 0.0:
+            torch._foreach_copy_(shadow_floats, online_floats)
+        else:
+            torch._foreach_lerp_(shadow_floats, online_floats, 1.0 - decay)
+
+        for i in others:
+            shadow[i].copy_(online[i])
+
+        return
+
+    def model_on(self, device):
+
+        # shadow model for inference on device, offloaded shadow is copied
+        # to device, the copy should be released after use
+        self.synchronize()
+        if torch.device(device) == self.device:
+            return self.module
+
+        return copy.deepcopy(self.module).to(device)
+
+    def state_dict(self):
+
+        self.synchronize()
+        return {
+            'step':  self.step,
+            'model': self.module.state_dict()
+        }
+
+    def load_state_dict(self, state_dict):
+
+        self.pending = None
+        if 'model' in state_dict:
+            self.step = state_dict['step']
+            model_dict = state_dict['model']
+        else:  # saved by EMA of ema-pytorch
+            self.step = int(state_dict['step'])
+            model_dict = strip_ema_prefix(state_dict)
+
+        # copies into existing tensors, which keeps shadow in pinned memory
+        self.module.load_state_dict(model_dict)
+
+        return
+
+
+def strip_ema_prefix(state_dict):
+
+    # state dict of EMA of ema-pytorch contains both online and shadow
+    # models, returns state dict of shadow model which works with define_G
+    prefix = 'ema_model.'
+    if not any(key.startswith(prefix) for key in state_dict):
+        return state_dict
+
+    return {
+        key[len(prefix):]: value
+        for key, value in state_dict.items()
+        if key.startswith(prefix)
+    }
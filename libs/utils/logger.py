@@ -2,46 +2,101 @@ import time
 import torch
 import datetime
 
+from .dist import all_reduce_sum
 from collections import defaultdict, deque
 
 
 class SmoothedValue(object):
+    # values are written into a ring buffer of window_size and summed on
+    # device of the first value, so that logging losses does not sync with
+    # host, values are copied to host only when they are read
 
     def __init__(self, window_size=100, fmt=None):
         if fmt is None:
             fmt = '{global_avg:.4f}'
 
-        self.deque = deque(maxlen=window_size)
-        self.total = 0.0
-        self.count = 0
+        self.window_size = window_size
+        self.ring    = None
+        self.sum     = None
+        self.updates = 0
+        self.total   = 0.0
+        self.count   = 0
+        self.window  = []
+        self.dirty   = False
         self.fmt = fmt
 
     def update(self, value, n=1):
-        self.deque.append(value)
+        if isinstance(value, torch.Tensor):
+            value = value.detach().reshape(())
+        if self.ring is None:
+            device = value.device if isinstance(value, torch.Tensor) else 'cpu'
+            self.ring = torch.zeros(self.window_size, dtype=torch.float64, device=device)
+            self.sum  = torch.zeros(1, dtype=torch.float64, device=device)
+
+        # value is copied into the ring, as loss may be changed in place
+        slot = self.ring[self.updates % self.window_size]
+        if isinstance(value, torch.Tensor):
+            slot.copy_(value)
+        else:
+            slot.fill_(value)
+        self.sum.add_(slot, alpha=n)
+
+        self.updates += 1
         self.count += n
-        self.total += value * n
+        self.dirty = True
+
+    def pending(self):
+        # running sum and ring buffer on device, to be read at once
+        return torch.cat([self.sum, self.ring])
+
+    def load(self, values):
+        # values read from pending, window is ordered from oldest
+        self.total = values[0]
+        ring = values[1:]
+        if self.updates < self.window_size:
+            self.window = ring[:self.updates]
+        else:
+            start = self.updates % self.window_size
+            self.window = ring[start:] + ring[:start]
+        self.dirty = False
+
+    def materialize(self):
+        if self.dirty:
+            self.load(self.pending().tolist())
+
+    def synchronize_between_processes(self):
+        # window is not synchronized, only global_avg is
+        self.materialize()
+        self.count, self.total = all_reduce_sum([self.count, self.total])
+        self.count = int(self.count)
+        if self.sum is not None:
+            self.sum.fill_(self.total)
 
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
-        return d.median().item()
+        self.materialize()
+        d = sorted(self.window)
+        return d[(len(d) - 1) // 2]
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
-        return d.mean().item()
+        self.materialize()
+        return sum(self.window) / len(self.window)
 
     @property
     def global_avg(self):
+        self.materialize()
         return self.total / self.count
 
     @property
     def max(self):
-        return max(self.deque)
+        self.materialize()
+        return max(self.window)
 
     @property
     def value(self):
-        return self.deque[-1]
+        self.materialize()
+        return self.window[-1]
 
     def __str__(self):
         return self.fmt.format(
@@ -62,14 +117,27 @@ class MetricLogger(object):
         self.print_freq = print_freq
 
     def update(self, **kwargs):
+        # tensors are kept on device until meters are printed or synchronized
         for k, v in kwargs.items():
             if v is None:
                 continue
-            if isinstance(v, torch.Tensor):
-                v = v.item()
-            assert isinstance(v, (float, int))
+            assert isinstance(v, (float, int, torch.Tensor))
             self.meters[k].update(v)
 
+    def materialize(self):
+        # reads all updated meters with one copy to host per device
+        groups = defaultdict(list)
+        for meter in self.meters.values():
+            if meter.dirty:
+                groups[meter.ring.device].append(meter)
+
+        for meters in groups.values():
+            values = torch.cat([m.pending() for m in meters]).tolist()
+            for meter in meters:
+                size = meter.window_size + 1
+                meter.load(values[:size])
+                values = values[size:]
+
     def __getattr__(self, attr):
         if attr in self.meters:
             return self.meters[attr]
@@ -79,11 +147,17 @@ class MetricLogger(object):
             type(self).__name__, attr))
 
     def __str__(self):
+        self.materialize()
         loss_str = []
         for name, meter in self.meters.items():
             loss_str.append('{}:{}'.format(name, str(meter)))
         return self.delimiter.join(loss_str)
 
+    def synchronize_between_processes(self):
+        self.materialize()
+        for meter in self.meters.values():
+            meter.synchronize_between_processes()
+
     def add_meter(self, name, meter):
         self.meters[name] = meter
 
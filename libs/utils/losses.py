@@ -64,10 +64,11 @@ class SimLoss(nn.Module):
             raise NotImplementedError(f'sim mode {mode} not implemented')
 
     def forward(self, prediction, target):
-        # range in [0, 1]
-        target_ = (target + 1.0) / 2.0
-        prediction_ = (prediction + 1.0) / 2.0
-        sim_loss = 1 - self.sim(prediction_, target_)
+        # range in [0, 1], computed in fp32 under autocast
+        with torch.autocast(prediction.device.type, enabled=False):
+            target_ = (target.float() + 1.0) / 2.0
+            prediction_ = (prediction.float() + 1.0) / 2.0
+            sim_loss = 1 - self.sim(prediction_, target_)
         return sim_loss * self.weight
 
 
@@ -141,7 +142,7 @@ class MSGANLoss(nn.Module):
             else:
                 return input.mean()
 
-    def __call__(self, input, target_is_real, for_D=True):
+    def forward(self, input, target_is_real, for_D=True):
         if isinstance(input, list):
             loss = 0
             for pred_i in input:
@@ -175,6 +176,7 @@ class FocalLoss(nn.Module):
 
     def forward(self, prediction, target):
 
+        # computed in fp32 under autocast
         preds = prediction.view(-1, prediction.size(-1)).float()
         alpha = self.alpha.to(preds.device)
         preds_logsoft = F.log_softmax(preds, dim=1)
@@ -248,8 +250,8 @@ class EvalMetrics(nn.Module):
 
     def forward(self, prediction, target):
         # range in [0, 255]
-        target_ = (target + 1.0) / 2.0 * 255.0
-        prediction_ = (prediction + 1.0) / 2.0 * 255.0
+        target_ = (target.float() + 1.0) / 2.0 * 255.0
+        prediction_ = (prediction.float() + 1.0) / 2.0 * 255.0
 
         psnr = self.psnr(prediction_, target_)
         ssim = self.ssim(prediction_, target_)
@@ -0,0 +1,131 @@
+import os
+import json
+import struct
+import imageio.v2 as iio
+
+from tqdm import tqdm
+from os.path import join as opj
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_FILE = 'manifest.json'
+
+# number of channels of each png color type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+
+def parse_level(file):
+    return int(file.split('_')[2][0])
+
+
+def _read_shape(image_path):
+    # reads shape from png header instead of decoding the whole image
+
+    with open(image_path, 'rb') as f:
+        header = f.read(26)
+
+    if header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', header[16:24])
+        return [height, width, PNG_CHANNELS[header[25]]]
+
+    return list(iio.imread(image_path).shape)
+
+
+def _scan_pair(data_dir, file):
+
+    he_path  = opj(data_dir, 'HE', file)
+    ihc_path = opj(data_dir, 'IHC', file)
+    he_stat  = os.stat(he_path)
+    ihc_stat = os.stat(ihc_path)
+
+    sample = {
+        'file':      file,
+        'he':        opj('HE', file),
+        'ihc':       opj('IHC', file),
+        'level':     parse_level(file),
+        'shape':     _read_shape(he_path),
+        'he_bytes':  he_stat.st_size,
+        'ihc_bytes': ihc_stat.st_size,
+        'he_mtime':  he_stat.st_mtime,
+        'ihc_mtime': ihc_stat.st_mtime
+    }
+
+    return sample
+
+
+def _is_changed(data_dir, sample):
+
+    he_stat  = os.stat(opj(data_dir, sample['he']))
+    ihc_stat = os.stat(opj(data_dir, sample['ihc']))
+    changed  = (he_stat.st_size   != sample['he_bytes'])  or \
+               (ihc_stat.st_size  != sample['ihc_bytes']) or \
+               (he_stat.st_mtime  != sample['he_mtime'])  or \
+               (ihc_stat.st_mtime != sample['ihc_mtime'])
+
+    return changed
+
+
+def _dir_mtimes(data_dir):
+    # mtimes of image directories, which change if pairs are added or removed
+    return [os.stat(opj(data_dir, d)).st_mtime_ns for d in ['HE', 'IHC']]
+
+
+def build_manifest(data_dir, num_threads=16, rescan=False):
+    # scans pairs in data_dir and saves them in data_dir/manifest.json,
+    # only new pairs are scanned if manifest exists, and all pairs are
+    # checked by size and mtime if rescan is True
+
+    manifest_path = opj(data_dir, MANIFEST_FILE)
+    samples = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            samples = {s['file']: s for s in json.load(f)['samples']}
+
+    # mtimes are taken before listing, so that pairs added meanwhile
+    # are found by the next load
+    dir_mtimes = _dir_mtimes(data_dir)
+    files = set(os.listdir(opj(data_dir, 'HE')))
+    samples = {f: s for f, s in samples.items() if f in files}
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        if rescan and (len(samples) > 0):
+            old_samples = list(samples.values())
+            changed = executor.map(lambda s: _is_changed(data_dir, s), old_samples)
+            for sample, is_changed in zip(old_samples, changed):
+                if is_changed:
+                    samples.pop(sample['file'])
+
+        new_files = sorted([f for f in files if f not in samples])
+        scanned = executor.map(lambda f: _scan_pair(data_dir, f), new_files)
+        for sample in tqdm(scanned, total=len(new_files), desc='Manifest', ncols=88,
+                           disable=len(new_files) == 0):
+            samples[sample['file']] = sample
+
+    samples = [samples[f] for f in sorted(samples.keys())]
+    manifest = {'num_samples': len(samples), 'dir_mtimes': dir_mtimes, 'samples': samples}
+
+    # writes to temporary file then replaces, readers never see partial files,
+    # temporary file is of this process, as ranks and loaders can build at once
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+    print(f'- Manifest of {len(samples)} pairs, {len(new_files)} scanned: {manifest_path}')
+    return samples
+
+
+def load_manifest(data_dir):
+    # returns samples sorted by file name, builds manifest if not exist,
+    # or updates it if image directories are changed since it was built
+
+    manifest_path = opj(data_dir, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return build_manifest(data_dir)
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    if manifest.get('dir_mtimes', None) != _dir_mtimes(data_dir):
+        return build_manifest(data_dir)
+
+    return manifest['samples']
@@ -0,0 +1,270 @@
+import torch
+import numpy as np
+
+from functools import lru_cache
+
+
+HE_STAT = {
+    'channel_mean': np.array([[[162.5, 137.9, 159.45]]]),
+    'channel_std':  np.array([[[35.8,  43.0,  31.6]]]),
+    'global_mean':  153.3,
+    'global_std':   38.7,
+    'global_min':   0.0,
+    'global_max':   255.0
+}
+
+IHC_STAT = {
+    'channel_mean': np.array([[[196.0, 190.2, 183.6]]]),
+    'channel_std':  np.array([[[39.1,  40.7,  44.3]]]),
+    'global_mean':  189.9,
+    'global_std':   41.7,
+    'global_min':   0.0,
+    'global_max':   255.0
+}
+
+NORM_METHODS = ['global_minmax', 'global_zscore', 'channel_zscore']
+
+# lookup tables and affine coefficients moved to devices,
+# keyed by (image_type, norm_method, device)
+_DEVICE_LUTS = {}
+_DEVICE_AFFINES = {}
+
+
+def _get_stat(image_type):
+
+    if image_type == 'he':
+        stat = HE_STAT
+    elif image_type == 'ihc':
+        stat = IHC_STAT
+    else:
+        raise ValueError('unknown image_type')
+
+    return stat
+
+
+def _normalize_arith(image, stat, norm_method):
+    # reference arithmetic, channels in the last axis
+
+    if norm_method == 'channel_zscore':
+        mean_ = stat['channel_mean'].reshape(-1)
+        std_  = stat['channel_std'].reshape(-1)
+        if isinstance(image, torch.Tensor):
+            mean_ = torch.as_tensor(mean_, dtype=image.dtype, device=image.device)
+            std_  = torch.as_tensor(std_,  dtype=image.dtype, device=image.device)
+        image_norm = (image - mean_) / std_
+    elif norm_method == 'global_zscore':
+        image_norm = (image - stat['global_mean']) / stat['global_std']
+    elif norm_method == 'global_minmax':
+        global_range = stat['global_max'] - stat['global_min']
+        image_norm = (image - stat['global_min']) / global_range
+        image_norm = image_norm * 2.0 - 1.0
+    else:
+        raise ValueError('unknown norm_method')
+
+    return image_norm
+
+
+def _unnormalize_arith(image, stat, norm_method):
+    # reference arithmetic, channels in the last axis
+
+    if norm_method == 'channel_zscore':
+        mean_ = stat['channel_mean'].reshape(-1)
+        std_  = stat['channel_std'].reshape(-1)
+        if isinstance(image, torch.Tensor):
+            mean_ = torch.as_tensor(mean_, dtype=image.dtype, device=image.device)
+            std_  = torch.as_tensor(std_,  dtype=image.dtype, device=image.device)
+        image_unnorm = image * std_ + mean_
+    elif norm_method == 'global_zscore':
+        image_unnorm = image * stat['global_std'] + stat['global_mean']
+    elif norm_method == 'global_minmax':
+        image_unnorm = (image + 1.0) / 2.0
+        global_range = stat['global_max'] - stat['global_min']
+        image_unnorm = image_unnorm * global_range + stat['global_min']
+    else:
+        raise ValueError('unknown norm_method')
+
+    return image_unnorm
+
+
+@lru_cache(maxsize=None)
+def get_norm_lut(image_type, norm_method='global_minmax'):
+    # float32 table of shape (256, 3), lut[v, c] is the normalized
+    # value of intensity v in channel c, computed in float64 once
+
+    stat = _get_stat(image_type)
+    values = np.repeat(np.arange(256, dtype=np.float64)[:, None], 3, axis=1)
+    lut = _normalize_arith(values, stat, norm_method).astype(np.float32)
+    lut.setflags(write=False)
+
+    return lut
+
+
+def _get_device_lut(image_type, norm_method, device):
+
+    key = (image_type, norm_method, str(device))
+    if key not in _DEVICE_LUTS:
+        lut = get_norm_lut(image_type, norm_method)
+        # flattened as [channel 0 table, channel 1 table, channel 2 table]
+        lut = torch.from_numpy(lut.T.copy()).reshape(-1)
+        _DEVICE_LUTS[key] = lut.to(device)
+
+    return _DEVICE_LUTS[key]
+
+
+@lru_cache(maxsize=None)
+def get_unnorm_affine(image_type, norm_method='global_minmax'):
+    # float32 scale and offset of shape (3,), unnormalized value of
+    # channel c is x * scale[c] + offset[c], computed in float64 once
+
+    stat = _get_stat(image_type)
+    offset = _unnormalize_arith(np.zeros((1, 3)), stat, norm_method)
+    scale = _unnormalize_arith(np.ones((1, 3)), stat, norm_method) - offset
+    scale = scale.reshape(-1).astype(np.float32)
+    offset = offset.reshape(-1).astype(np.float32)
+    scale.setflags(write=False)
+    offset.setflags(write=False)
+
+    return scale, offset
+
+
+def _get_device_affine(image_type, norm_method, device, channels_first):
+
+    key = (image_type, norm_method, str(device), channels_first)
+    if key not in _DEVICE_AFFINES:
+        scale, offset = get_unnorm_affine(image_type, norm_method)
+        if norm_method != 'channel_zscore':
+            # same for all channels, scalars are cheaper than broadcasting
+            scale, offset = float(scale[0]), float(offset[0])
+        else:
+            shape = (-1, 1, 1) if channels_first else (-1,)
+            scale = torch.from_numpy(scale.copy()).view(shape).to(device)
+            offset = torch.from_numpy(offset.copy()).view(shape).to(device)
+        _DEVICE_AFFINES[key] = (scale, offset)
+
+    return _DEVICE_AFFINES[key]
+
+
+def _unnormalize_to_uint8(images, scale, offset):
+    # one affine pass into a fresh float tensor, clamped in place,
+    # followed by a single cast to uint8 in the same memory layout
+
+    images_unnorm = images.mul(scale)
+    images_unnorm.add_(offset).clamp_(0, 255)
+    if images_unnorm.device.type == 'cpu':
+        # numpy cast is several times faster than torch cast on cpu
+        return torch.from_numpy(images_unnorm.numpy().astype(np.uint8))
+
+    return images_unnorm.to(torch.uint8)
+
+
+def normalize_image(image, image_type, norm_method='global_minmax',
+                    channels_first=False):
+    # numpy array in (..., h, w, c) to float32 array in (..., h, w, c),
+    # or in (..., c, h, w) if channels_first is True
+
+    if image.dtype != np.uint8:
+        image_norm = _normalize_arith(image, _get_stat(image_type), norm_method)
+        if channels_first:
+            image_norm = np.moveaxis(image_norm, -1, -3)
+        return image_norm.astype(np.float32)
+
+    lut = get_norm_lut(image_type, norm_method)
+    *lead, h, w, c = image.shape
+    if channels_first:
+        image_norm = np.empty((*lead, c, h, w), dtype=np.float32)
+    else:
+        image_norm = np.empty(image.shape, dtype=np.float32)
+
+    # gathers over 2D planes are much faster than over strided 4D views,
+    # so leading dims are flattened and each image is processed in turn
+    images = image.reshape(-1, h, w, c)
+    images_norm = image_norm.reshape(-1, *image_norm.shape[-3:])
+    for image_, image_norm_ in zip(images, images_norm):
+        if channels_first:
+            image_norm_ = np.moveaxis(image_norm_, 0, -1)
+        # one gather for each channel, written in place into the output
+        for i in range(c):
+            np.take(lut[:, i], image_[..., i], out=image_norm_[..., i], mode='clip')
+
+    return image_norm
+
+
+def unnormalize_image(image, image_type, norm_method='global_minmax',
+                      to_uint8=False):
+    # numpy array in (..., h, w, c), returns uint8 array if to_uint8 is True
+
+    if to_uint8:
+        # torch elementwise kernels are faster than numpy ufuncs on cpu
+        scale, offset = _get_device_affine(image_type, norm_method, 'cpu', False)
+        image_unnorm = _unnormalize_to_uint8(torch.from_numpy(image), scale, offset)
+        return image_unnorm.numpy()
+
+    return _unnormalize_arith(image, _get_stat(image_type), norm_method)
+
+
+def normalize_batch(images, image_type, norm_method='global_minmax',
+                    channels_last=False):
+    # uint8 tensor in (..., h, w, c) to float32 tensor in (..., c, h, w),
+    # if channels_last is True, values are normalized in (..., h, w, c)
+    # and the permuted view, which is in channels last format, is returned
+
+    if images.dtype != torch.uint8:
+        stat = _get_stat(image_type)
+        images_norm = _normalize_arith(images.double(), stat, norm_method)
+        images_norm = images_norm.float().movedim(-1, -3)
+        return images_norm if channels_last else images_norm.contiguous()
+
+    if images.device.type == 'cpu':
+        # numpy gathers are faster than torch indexing on cpu
+        images_norm = normalize_image(
+            images.numpy(), image_type, norm_method,
+            channels_first=not channels_last
+        )
+        images_norm = torch.from_numpy(images_norm)
+        return images_norm.movedim(-1, -3) if channels_last else images_norm
+
+    lut = _get_device_lut(image_type, norm_method, images.device)
+    if channels_last:
+        images = images.contiguous()
+        offsets = torch.arange(
+            0, 256 * images.size(-1), 256,
+            dtype=torch.int32, device=images.device
+        )
+    else:
+        # permutes uint8 values before the gather, which is 4x cheaper
+        images = images.movedim(-1, -3).contiguous()
+        offsets = torch.arange(
+            0, 256 * images.size(-3), 256,
+            dtype=torch.int32, device=images.device
+        ).view(-1, 1, 1)
+
+    # single gather over all channels
+    index = images.int() + offsets
+    images_norm = lut.index_select(0, index.view(-1))
+    images_norm = images_norm.view(images.shape)
+    if channels_last:
+        images_norm = images_norm.movedim(-1, -3)
+
+    return images_norm
+
+
+def unnormalize_batch(images, image_type, norm_method='global_minmax',
+                      to_uint8=False):
+    # float tensor in (..., c, h, w) to float32 tensor in (..., h, w, c),
+    # returns uint8 tensor if to_uint8 is True
+
+    images = images.detach().float()
+    if to_uint8:
+        # affine pass over contiguous channels first values, the permuted
+        # view of uint8 values is returned without copying
+        scale, offset = _get_device_affine(image_type, norm_method, images.device, True)
+        images_unnorm = _unnormalize_to_uint8(images, scale, offset)
+        return images_unnorm.movedim(-3, -1)
+
+    images = images.movedim(-3, -1)
+    if images.device.type == 'cpu':
+        images_unnorm = unnormalize_image(images.numpy(), image_type, norm_method)
+        return torch.from_numpy(images_unnorm)
+
+    stat = _get_stat(image_type)
+    return _unnormalize_arith(images, stat, norm_method)
@@ -0,0 +1,143 @@
+import time
+import queue
+import torch
+import threading
+import imageio.v2 as iio
+
+
+class ImageReader(object):
+    # decodes images in order, used as loader of DevicePrefetcher
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        for path in self.paths:
+            yield iio.imread(path)
+
+
+class DevicePrefetcher(object):
+    # iterates a loader in a background thread and moves batches to
+    # device, on cuda the copies are issued in a side stream, so that
+    # next batches are transferred while current batch is computed
+
+    def __init__(self, loader, device, depth=2):
+
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth  = depth
+        self.stream = None
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(self.device)
+
+        # seconds waited for the last batch, and for all batches
+        self.wait_time  = 0.0
+        self.total_wait = 0.0
+
+        # copy of the last batch to device, seconds or timing events
+        self.copy_span = None
+
+        return
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, data):
+
+        if isinstance(data, torch.Tensor):
+            return data.to(self.device, non_blocking=True)
+        elif isinstance(data, (list, tuple)):
+            return type(data)(self._to_device(d) for d in data)
+        elif isinstance(data, dict):
+            return {k: self._to_device(v) for k, v in data.items()}
+        else:
+            return data
+
+    def _record_stream(self, data):
+        # tensors created in side stream are used in current stream
+
+        if isinstance(data, torch.Tensor):
+            if data.is_cuda:
+                data.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(data, (list, tuple)):
+            for d in data:
+                self._record_stream(d)
+        elif isinstance(data, dict):
+            for d in data.values():
+                self._record_stream(d)
+
+        return
+
+    def _worker(self, buffer, stop):
+
+        try:
+            for data in self.loader:
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        start = torch.cuda.Event(enable_timing=True)
+                        start.record(self.stream)
+                        data = self._to_device(data)
+                        event = torch.cuda.Event(enable_timing=True)
+                        event.record(self.stream)
+                    copy_span = (start, event)
+                else:
+                    start = time.perf_counter()
+                    data = self._to_device(data)
+                    copy_span = time.perf_counter() - start
+
+                while not stop.is_set():
+                    try:
+                        buffer.put((data, event, copy_span, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+        except Exception as e:
+            buffer.put((None, None, None, e))
+            return
+
+        buffer.put((None, None, None, StopIteration()))
+        return
+
+    def __iter__(self):
+
+        buffer = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        worker = threading.Thread(
+            target=self._worker, args=(buffer, stop), daemon=True
+        )
+        worker.start()
+        self.total_wait = 0.0
+
+        try:
+            while True:
+                start = time.perf_counter()
+                data, event, copy_span, error = buffer.get()
+                if event is not None:
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    self._record_stream(data)
+                self.wait_time = time.perf_counter() - start
+                self.total_wait += self.wait_time
+                self.copy_span = copy_span
+
+                if isinstance(error, StopIteration):
+                    break
+                elif error is not None:
+                    raise error
+
+                yield data
+        finally:
+            # releases worker if iteration is stopped early
+            stop.set()
+            while worker.is_alive():
+                try:
+                    buffer.get_nowait()
+                except queue.Empty:
+                    worker.join(timeout=0.1)
+
+        return
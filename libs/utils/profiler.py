@@ -0,0 +1,177 @@
+import os
+import time
+import torch
+import signal
+import threading
+
+from torch.profiler import ProfilerActivity, record_function
+from .dist import get_rank, get_world_size
+from ..models.layers import ModConv2d
+
+
+class StepProfiler(object):
+    # profiles steps with torch.profiler, in cycles of wait, warmup and
+    # active steps repeated for repeat times, chrome traces and tables of
+    # top operators are saved in output_dir, profiling starts after the
+    # first step if enabled, or after the step in which the process gets
+    # signal, so that a running job can be profiled without restarting,
+    # such as by: kill -USR1 <pid>
+
+    def __init__(self, params, output_dir, device, regions=None, name='train'):
+
+        params = {} if params is None else params
+        self.wait      = params.get('wait', 1)
+        self.warmup    = params.get('warmup', 1)
+        self.active    = params.get('active', 3)
+        self.repeat    = params.get('repeat', 1)
+        self.row_limit = params.get('row_limit', 20)
+        self.record_shapes  = params.get('record_shapes', True)
+        self.profile_memory = params.get('profile_memory', True)
+        self.with_stack     = params.get('with_stack', True)
+
+        self.output_dir = output_dir
+        self.cuda       = torch.device(device).type == 'cuda'
+        self.regions    = regions
+        self.name       = name
+        self.armed      = params.get('enabled', False)
+        self.profiler   = None
+        self.handles    = []
+
+        # handler is set in main thread only, as required by signal
+        signame = params.get('signal', 'SIGUSR1')
+        signum  = getattr(signal, str(signame), None)
+        if (signum is not None) and \
+           (threading.current_thread() is threading.main_thread()):
+            signal.signal(signum, self._on_signal)
+
+        return
+
+    def _on_signal(self, signum, frame):
+        self.armed = True
+        return
+
+    def step(self):
+
+        if self.profiler is None:
+            if not self.armed:
+                return
+            self._start()
+            return
+
+        self.profiler.step()
+        self.steps += 1
+        if self.steps >= self.total_steps:
+            self.stop()
+
+        return
+
+    def _start(self):
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.armed = False
+        self.steps = 0
+        self.cycle = 0
+        self.total_steps = (self.wait + self.warmup + self.active) * self.repeat
+        self.prefix = f'{self.name}-{time.strftime("%Y%m%d-%H%M%S")}'
+        if get_world_size() > 1:
+            self.prefix += f'-rank{get_rank()}'
+
+        activities = [ProfilerActivity.CPU]
+        if self.cuda:
+            activities.append(ProfilerActivity.CUDA)
+
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=self.wait,
+                warmup=self.warmup,
+                active=self.active,
+                repeat=self.repeat
+            ),
+            on_trace_ready=self._export,
+            record_shapes=self.record_shapes,
+            profile_memory=self.profile_memory,
+            with_stack=self.with_stack
+        )
+        self._label_regions()
+        self.profiler.start()
+        print(f'Profile {self.total_steps} steps of {self.name}')
+
+        return
+
+    def stop(self):
+
+        # saves the active steps recorded so far
+        if self.profiler is None:
+            return
+
+        self.profiler.stop()
+        self.profiler = None
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+        return
+
+    def _export(self, prof):
+
+        path = os.path.join(self.output_dir, f'{self.prefix}-{self.cycle}')
+        self.cycle += 1
+        prof.export_chrome_trace(path + '.json')
+
+        sort_by = 'self_device_time_total' if self.cuda else 'self_cpu_time_total'
+        table = prof.key_averages(group_by_input_shape=self.record_shapes).table(
+            sort_by=sort_by, row_limit=self.row_limit
+        )
+        with open(path + '.txt', mode='w', encoding='utf-8') as f:
+            f.write(table + '\n')
+        print(f'- Profile: {path}.json')
+
+        return
+
+    def _label_regions(self):
+
+        # forwards of modules are labeled by hooks, which are only set
+        # while profiling, so that other steps have no overhead
+        if self.regions is None:
+            return
+
+        for name, module in self.regions():
+            records = []
+
+            def enter(module, args, name=name, records=records):
+                records.append(record_function(name))
+                records[-1].__enter__()
+
+            def leave(module, args, output, records=records):
+                records.pop().__exit__(None, None, None)
+
+            self.handles.append(module.register_forward_pre_hook(enter))
+            self.handles.append(module.register_forward_hook(leave))
+
+        return
+
+
+def profile_regions(G=None, D=None, losses=None):
+    # labels and modules in profiles: stacks of G, ModConv2d layers,
+    # which share a label to be summed in tables, scales of multiscale
+    # D, and losses
+
+    regions = []
+    if G is not None:
+        for name in ['encoder1', 'decoder1', 'decoder2', 'mask_decoder']:
+            if hasattr(G, name):
+                regions.append((f'G.{name}', getattr(G, name)))
+        for module in G.modules():
+            if isinstance(module, ModConv2d):
+                regions.append(('ModConv2d', module))
+
+    if D is not None:
+        for i in range(getattr(D, 'num_depths', 0)):
+            regions.append((f'D.layer{i}', getattr(D, f'layer{i}')))
+
+    if losses is not None:
+        for name, loss in losses.items():
+            regions.append((f'loss.{name}', loss))
+
+    return regions
@@ -0,0 +1,107 @@
+import os
+import json
+import numpy as np
+import imageio.v2 as iio
+
+from tqdm import tqdm
+from os.path import join as opj
+
+from .manifest import load_manifest
+
+
+SHARD_INDEX = 'index.json'
+
+
+def build_shards(data_dir, shard_dir=None, shard_size=256):
+    # packs HE/IHC pairs into uint8 arrays of shape (n, 2, h, w, c)
+    # so that datasets can slice samples out of memory-mapped files
+
+    if shard_dir is None:
+        shard_dir = opj(data_dir, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+
+    manifest = load_manifest(data_dir)
+    assert len(manifest) > 0, f'no image found in {data_dir}'
+    shape = manifest[0]['shape']
+
+    shards, samples = [], []
+    for start in range(0, len(manifest), shard_size):
+        shard_samples = manifest[start:start + shard_size]
+        shard_file  = f'shard-{len(shards):05d}.npy'
+        shard_array = np.lib.format.open_memmap(
+            opj(shard_dir, shard_file), mode='w+', dtype=np.uint8,
+            shape=(len(shard_samples), 2, *shape)
+        )
+
+        desc = f'{shard_file}'
+        for offset, sample in enumerate(tqdm(shard_samples, desc=desc, ncols=88)):
+            f   = sample['file']
+            he  = iio.imread(opj(data_dir, sample['he']))
+            ihc = iio.imread(opj(data_dir, sample['ihc']))
+            assert list(he.shape) == shape and list(ihc.shape) == shape, \
+                f'shape of {f} is different from {shape}'
+
+            shard_array[offset, 0] = he
+            shard_array[offset, 1] = ihc
+            samples.append({
+                'file':   f,
+                'level':  sample['level'],
+                'shard':  len(shards),
+                'offset': offset
+            })
+
+        shard_array.flush()
+        del shard_array
+        shards.append(shard_file)
+
+    index = {'shape': shape, 'shards': shards, 'samples': samples}
+    with open(opj(shard_dir, SHARD_INDEX), 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+
+    print(f'- Packed {len(samples)} pairs into {len(shards)} shards: {shard_dir}')
+    return
+
+
+class ShardStore(object):
+
+    def __init__(self, shard_dir):
+
+        index_path = opj(shard_dir, SHARD_INDEX)
+        if not os.path.isfile(index_path):
+            raise IOError(f'shard index {index_path} is not exist, '
+                          'run prepare_data.py first')
+
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+
+        self.shard_dir  = shard_dir
+        self.shape      = index['shape']
+        self.shards     = index['shards']
+        self.files      = [s['file'] for s in index['samples']]
+        self.levels     = [s['level'] for s in index['samples']]
+        self.locations  = [(s['shard'], s['offset']) for s in index['samples']]
+
+        # memory maps are opened lazily in each process
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+    def _open(self, shard):
+
+        if shard not in self._arrays:
+            shard_path = opj(self.shard_dir, self.shards[shard])
+            self._arrays[shard] = np.load(shard_path, mmap_mode='r')
+
+        return self._arrays[shard]
+
+    def read(self, index):
+        # returns read-only views into the memory-mapped shard
+        shard, offset = self.locations[index]
+        pair = self._open(shard)[offset]
+        return pair[0], pair[1]
@@ -0,0 +1,246 @@
+import os
+import io
+import json
+import random
+import tarfile
+import numpy as np
+import imageio.v2 as iio
+
+from tqdm import tqdm
+from os.path import join as opj
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .manifest import load_manifest
+from .dist import get_rank, get_world_size
+
+
+STREAM_INDEX = 'index.json'
+
+
+def build_stream(data_dir, stream_dir=None, shard_size=256):
+    # packs encoded HE/IHC pngs into tar files, which are read
+    # sequentially by ShardStreamDataset, pairs are adjacent members
+
+    if stream_dir is None:
+        stream_dir = opj(data_dir, 'stream')
+    os.makedirs(stream_dir, exist_ok=True)
+
+    manifest = load_manifest(data_dir)
+    assert len(manifest) > 0, f'no image found in {data_dir}'
+
+    shards, samples = [], []
+    for start in range(0, len(manifest), shard_size):
+        shard_samples = manifest[start:start + shard_size]
+        shard_file = f'stream-{len(shards):05d}.tar'
+
+        desc = f'{shard_file}'
+        with tarfile.open(opj(stream_dir, shard_file), 'w') as tar:
+            for sample in tqdm(shard_samples, desc=desc, ncols=88):
+                tar.add(opj(data_dir, sample['he']),  arcname=sample['he'])
+                tar.add(opj(data_dir, sample['ihc']), arcname=sample['ihc'])
+                samples.append({
+                    'file':  sample['file'],
+                    'level': sample['level'],
+                    'shard': len(shards)
+                })
+
+        shards.append({'file': shard_file, 'samples': len(shard_samples)})
+
+    index = {'shape': manifest[0]['shape'], 'shards': shards, 'samples': samples}
+    with open(opj(stream_dir, STREAM_INDEX), 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+
+    print(f'- Packed {len(samples)} pairs into {len(shards)} tar shards: {stream_dir}')
+    return
+
+
+def load_stream_index(stream_dir):
+
+    index_path = opj(stream_dir, STREAM_INDEX)
+    if not os.path.isfile(index_path):
+        raise IOError(f'stream index {index_path} is not exist, '
+                      'run prepare_data.py with --build_stream true first')
+
+    with open(index_path, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+
+    return index
+
+
+class ShardStreamDataset(IterableDataset):
+    # reads pairs sequentially from tar shards, shards are concatenated in
+    # order of epoch and split into contiguous ranges of samples, which are
+    # equal across ranks and whole batches across loader workers, so that
+    # every rank takes the same number of steps, samples are shuffled in a
+    # bounded buffer of encoded pairs, process is the per-sample transform
+    # of map-style datasets, so that samples are the same as theirs
+
+    def __init__(self, stream_dir, process, shuffle=False, buffer_size=64,
+                 seed=0, start_shard=0, with_index=False, batch_size=1,
+                 drop_last=False):
+        super(ShardStreamDataset, self).__init__()
+
+        index = load_stream_index(stream_dir)
+        self.stream_dir  = stream_dir
+        self.shards      = [s['file'] for s in index['shards']]
+        self.num_samples = [s['samples'] for s in index['shards']]
+        self.levels      = {s['file']: s['level'] for s in index['samples']}
+        self.indices     = {s['file']: i for i, s in enumerate(index['samples'])}
+
+        self.process     = process
+        self.shuffle     = shuffle
+        self.buffer_size = buffer_size
+        # same in all processes, as shard orders of ranks must agree
+        self.seed        = seed
+        self.epoch       = 0
+        self.start_shard = start_shard
+        self.with_index  = with_index
+        self.batch_size  = batch_size
+        self.drop_last   = drop_last
+
+        # rank is taken in main process, as loader workers are not in
+        # process group
+        self.rank  = get_rank()
+        self.world = get_world_size()
+
+        return
+
+    def set_epoch(self, epoch, start_shard=0):
+        # shards of this epoch before start_shard are skipped for resuming
+        self.epoch = epoch
+        self.start_shard = start_shard
+        return
+
+    def _shard_order(self):
+        # shards in order of this epoch
+
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+
+        return order[self.start_shard:]
+
+    def _rank_range(self, total):
+        # range of samples of current rank, ranks take the same number of
+        # samples, the remainder is dropped if drop_last, or padded by
+        # samples from the beginning, as DistributedSampler does
+
+        if self.drop_last:
+            per_rank = total // self.world
+        else:
+            per_rank = (total + self.world - 1) // self.world
+
+        return self.rank * per_rank, (self.rank + 1) * per_rank
+
+    def _num_batches(self, num_samples):
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return (num_samples + self.batch_size - 1) // self.batch_size
+
+    def __len__(self):
+        # samples yielded by current rank, which are whole batches
+        # if drop_last, so that length of loader is the number of steps
+
+        order = self._shard_order()
+        start, stop = self._rank_range(sum(self.num_samples[s] for s in order))
+        if self.drop_last:
+            return self._num_batches(stop - start) * self.batch_size
+
+        return stop - start
+
+    def _segments(self, order, start, stop):
+        # (shard, first, last) samples of shards in range of samples,
+        # range beyond the total wraps around to the beginning
+
+        total = sum(self.num_samples[s] for s in order)
+        segments = []
+        while (start < stop) and (total > 0):
+            offset = 0
+            for shard in order:
+                first = max(start - offset, 0)
+                last  = min(stop - offset, self.num_samples[shard])
+                if first < last:
+                    segments.append((shard, first, last))
+                offset += self.num_samples[shard]
+            start, stop = max(start - total, 0), stop - total
+
+        return segments
+
+    def _read_shard(self, shard, first=0, last=None):
+
+        shard_path = opj(self.stream_dir, self.shards[shard])
+        with tarfile.open(shard_path, 'r|') as tar:
+            pair, i = {}, 0
+            for member in tar:
+                image_type, file = member.name.split('/', 1)
+                if i < first:
+                    # data of skipped members is still read through
+                    # by the streaming tar, but it is not extracted
+                    if image_type == 'IHC':
+                        i += 1
+                    continue
+                pair[image_type] = tar.extractfile(member).read()
+                if len(pair) == 2:
+                    yield file, pair['HE'], pair['IHC']
+                    pair, i = {}, i + 1
+                    if (last is not None) and (i >= last):
+                        break
+
+        return
+
+    def _read_samples(self, segments, rng):
+
+        buffer = []
+        for segment in segments:
+            for sample in self._read_shard(*segment):
+                if len(buffer) < self.buffer_size:
+                    buffer.append(sample)
+                    continue
+                i = rng.randrange(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+                yield sample
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+        return
+
+    def __iter__(self):
+
+        order = self._shard_order()
+        start, stop = self._rank_range(sum(self.num_samples[s] for s in order))
+        stop = start + len(self)
+
+        # workers take contiguous runs of whole batches, only the last
+        # batch of rank can be partial, which is batched as the last one
+        worker_info = get_worker_info()
+        worker_id = 0
+        if worker_info is not None:
+            worker_id   = worker_info.id
+            num_workers = worker_info.num_workers
+            num_batches = self._num_batches(stop - start)
+            per_worker, remainder = divmod(num_batches, num_workers)
+            first = worker_id * per_worker + min(worker_id, remainder)
+            last  = first + per_worker + (worker_id < remainder)
+            start, stop = (
+                min(start + first * self.batch_size, stop),
+                min(start + last * self.batch_size, stop)
+            )
+
+        segments = self._segments(order, start, stop)
+        if self.shuffle:
+            rng = random.Random(self.seed + self.epoch * 1000 + worker_id)
+            samples = self._read_samples(segments, rng)
+        else:
+            samples = (s for seg in segments for s in self._read_shard(*seg))
+
+        for file, he_bytes, ihc_bytes in samples:
+            he  = np.array(iio.imread(io.BytesIO(he_bytes)))
+            ihc = np.array(iio.imread(io.BytesIO(ihc_bytes)))
+            sample = self.process(he, ihc, self.levels[file])
+            if self.with_index:
+                # same index as map-style datasets, in order of manifest
+                sample = (*sample, self.indices[file])
+            yield sample
+
+        return
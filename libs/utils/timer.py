@@ -0,0 +1,88 @@
+import time
+import torch
+import contextlib
+
+from collections import defaultdict
+
+
+class StageTimer(object):
+    # accumulates seconds spent in named stages of steps, on cuda stages
+    # are timed by events recorded in current stream, which are read once
+    # they are done, so that timing does not wait for the device, or on
+    # host after the device is synchronized if sync, for steps which wait
+    # for results on host anyway
+
+    def __init__(self, device, sync=False):
+
+        self.cuda    = torch.device(device).type == 'cuda'
+        self.sync    = sync and self.cuda
+        self.totals  = defaultdict(float)
+        self.pending = []
+        self.start   = time.perf_counter()
+
+        return
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+
+        if self.sync:
+            torch.cuda.synchronize()
+        if (not self.cuda) or self.sync:
+            start = time.perf_counter()
+            yield
+            if self.sync:
+                torch.cuda.synchronize()
+            self.totals[name] += time.perf_counter() - start
+            return
+
+        start = torch.cuda.Event(enable_timing=True)
+        end   = torch.cuda.Event(enable_timing=True)
+        start.record()
+        yield
+        end.record()
+        self.add(name, (start, end))
+
+        return
+
+    def add(self, name, span):
+
+        # span is seconds measured on host, or a pair of timing events
+        if isinstance(span, tuple):
+            self.pending.append((name, *span))
+            self._collect()
+        elif span is not None:
+            self.totals[name] += span
+
+        return
+
+    def _collect(self, wait=False):
+
+        while len(self.pending) > 0:
+            name, start, end = self.pending[0]
+            if wait:
+                end.synchronize()
+            elif not end.query():
+                break
+            self.totals[name] += start.elapsed_time(end) / 1000
+            self.pending.pop(0)
+
+        return
+
+    def summary(self, prefix='time_'):
+
+        # seconds of all stages and in total, waits for pending events
+        self._collect(wait=True)
+        if self.cuda:
+            torch.cuda.synchronize()
+        summary = {prefix + k: v for k, v in self.totals.items()}
+        summary[prefix + 'total'] = time.perf_counter() - self.start
+
+        return summary
+
+    def reset(self):
+
+        self._collect(wait=True)
+        self.totals.clear()
+        self.start = time.perf_counter()
+
+        return
@@ -0,0 +1,214 @@
+import json
+import time
+import datetime
+import queue
+import sqlite3
+import threading
+
+from omegaconf import OmegaConf
+
+
+class JsonlSink(object):
+    # appends records as lines of json, such as log.txt
+
+    kinds = ('epoch',)
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def write(self, records):
+        if self.file is None:
+            self.file = open(self.path, mode='a', encoding='utf-8')
+        for record in records:
+            self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class SqliteSink(object):
+    # inserts records as json into table logs, connection is opened in
+    # thread of tracker, as required by sqlite3
+
+    kinds = ('epoch',)
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+
+    def write(self, records):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS logs (time REAL, record TEXT)'
+            )
+        now = time.time()
+        self.conn.executemany(
+            'INSERT INTO logs VALUES (?, ?)',
+            [(now, json.dumps(record)) for record in records]
+        )
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+class WandbSink(object):
+    # logs records to wandb, which is imported and initialized in thread
+    # of tracker, so that training does not wait for network, records of
+    # epochs are logged in keys of previous runs, train.* and validation.*
+    # with epoch and duration, and records of steps as they are, such as
+    # iteration_step, epoch and learning_rate
+
+    kinds = ('epoch', 'step')
+
+    def __init__(self, project, config=None, mode=None):
+        self.project = project
+        self.config  = config
+        self.mode    = mode
+        self.run     = None
+        self.start   = time.time()
+
+    def _wandb_keys(self, record):
+
+        if 'iteration_step' in record:
+            return record
+
+        logged = {
+            'epoch':    record['epoch'],
+            'duration': str(datetime.timedelta(seconds=int(time.time() - self.start)))
+        }
+        for key, value in record.items():
+            if key.startswith('t'):
+                logged[f'train.{key[1:]}'] = value
+            elif key.startswith('v'):
+                logged[f'validation.{key[1:]}'] = value
+
+        return logged
+
+    def write(self, records):
+        if self.run is None:
+            import wandb
+            config = self.config
+            if OmegaConf.is_config(config):
+                config = OmegaConf.to_container(config, resolve=True)
+            self.run = wandb.init(project=self.project, config=config, mode=self.mode)
+        for record in records:
+            self.run.log(self._wandb_keys(record))
+
+    def close(self):
+        if self.run is not None:
+            self.run.finish()
+
+
+class Tracker(object):
+    # logs records by sinks in a background thread, records are queued
+    # without waiting and written in batches, records are dropped and
+    # counted if the queue is full, so that memory is bounded and the
+    # training loop never waits for logging, records are of epochs or
+    # steps, and each sink only writes records of its kinds
+
+    def __init__(self, sinks, max_queue=1000, batch_size=64, flush_secs=1.0):
+
+        self.sinks      = sinks
+        self.kinds      = set(kind for sink in sinks for kind in sink.kinds)
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        self.dropped    = 0
+        self.buffer     = queue.Queue(maxsize=max_queue)
+        self.stop       = threading.Event()
+        self.worker     = threading.Thread(target=self._worker, daemon=True)
+        self.worker.start()
+
+        return
+
+    def log(self, record, kind='epoch'):
+
+        if kind not in self.kinds:
+            return
+
+        try:
+            self.buffer.put_nowait((kind, record))
+        except queue.Full:
+            self.dropped += 1
+
+        return
+
+    def _worker(self):
+
+        while not (self.stop.is_set() and self.buffer.empty()):
+            try:
+                records = [self.buffer.get(timeout=self.flush_secs)]
+            except queue.Empty:
+                continue
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.buffer.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(records)
+
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                print(f'Warning: failed to close {type(sink).__name__}: {e}')
+
+        return
+
+    def _write(self, records):
+
+        # sink failed to write, such as wandb without network, is removed
+        # and does not affect other sinks
+        for sink in list(self.sinks):
+            sink_records = [r for kind, r in records if kind in sink.kinds]
+            if len(sink_records) == 0:
+                continue
+            try:
+                sink.write(sink_records)
+            except Exception as e:
+                print(f'Warning: {type(sink).__name__} is disabled: {e}')
+                self.sinks.remove(sink)
+
+        return
+
+    def close(self, timeout=60):
+
+        # writes queued records and closes sinks
+        self.stop.set()
+        self.worker.join(timeout=timeout)
+        if self.dropped > 0:
+            print(f'Warning: {self.dropped} records are dropped by tracker')
+
+        return
+
+
+def build_tracker(params, log_path, config=None):
+    # sinks of tracker configs: jsonl writes log_path, sqlite writes
+    # log_path with suffix .sqlite, and wandb is optional
+
+    params = {} if params is None else params
+    sinks  = []
+    for name in params.get('sinks', ['jsonl']):
+        if name == 'jsonl':
+            sinks.append(JsonlSink(log_path))
+        elif name == 'sqlite':
+            sinks.append(SqliteSink(log_path.rsplit('.', 1)[0] + '.sqlite'))
+        elif name == 'wandb':
+            sinks.append(WandbSink(
+                project=params.get('project', 'bci-stainer-retrained'),
+                config=config, mode=params.get('mode', None)
+            ))
+        else:
+            raise ValueError(f'Unknown sink {name}')
+
+    return Tracker(
+        sinks,
+        max_queue=params.get('max_queue', 1000),
+        batch_size=params.get('batch_size', 64),
+        flush_secs=params.get('flush_secs', 1.0)
+    )
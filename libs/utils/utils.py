@@ -2,25 +2,10 @@ import os
 import torch
 import random
 import numpy as np
+import torch.nn.functional as F
 
-
-HE_STAT = {
-    'channel_mean': np.array([[[162.5, 137.9, 159.45]]]),
-    'channel_std':  np.array([[[35.8,  43.0,  31.6]]]),
-    'global_mean':  153.3,
-    'global_std':   38.7,
-    'global_min':   0.0,
-    'global_max':   255.0
-}
-
-IHC_STAT = {
-    'channel_mean': np.array([[[196.0, 190.2, 183.6]]]),
-    'channel_std':  np.array([[[39.1,  40.7,  44.3]]]),
-    'global_mean':  189.9,
-    'global_std':   41.7,
-    'global_min':   0.0,
-    'global_max':   255.0
-}
+from .norm import *
+from ..models import downsample_pyramid
 
 
 def check_train_args(args):
@@ -37,6 +22,9 @@ def check_train_args(args):
     if args.trainer not in ['basic', 'cahr']:
         raise ValueError('trainer is not one of basic or cahr')
 
+    if args.launcher not in ['none', 'pytorch']:
+        raise ValueError('launcher is not one of none or pytorch')
+
     return
 
 
@@ -61,6 +49,20 @@ def check_evaluate_args(args):
     return
 
 
+def check_prepare_args(args):
+
+    if not os.path.isdir(args.data_dir):
+        raise IOError(f'data_dir {args.data_dir} is not exist')
+
+    if args.shard_size <= 0:
+        raise ValueError('shard_size should be positive')
+
+    if args.num_threads <= 0:
+        raise ValueError('num_threads should be positive')
+
+    return
+
+
 def init_environment(seed):
 
     # sets seed for completely reproducible results
@@ -75,68 +77,6 @@ def init_environment(seed):
     return
 
 
-def normalize_image(image, image_type, norm_method='global_minmax'):
-    assert norm_method == 'global_minmax', \
-        'only support global_minmax for norm_method'
-
-    if image_type == 'he':
-        stat = HE_STAT
-    elif image_type == 'ihc':
-        stat = IHC_STAT
-    else:
-        raise ValueError('unknown image_type')
-
-    if norm_method == 'channel_zscore':
-        if image.ndims == 3:
-            mean_ = stat['channel_mean']
-            std_  = stat['channel_std']
-        elif image.ndims == 4:
-            mean_ = stat['channel_mean'][None, ...]
-            std_  = stat['channel_std'][None, ...]
-        image_norm = (image - mean_) / std_
-    elif norm_method == 'global_zscore':
-        image_norm = (image - stat['global_mean']) / stat['global_std']
-    elif norm_method == 'global_minmax':
-        global_range =  stat['global_max'] - stat['global_min']
-        image_norm = (image - stat['global_min']) / global_range
-        image_norm = image_norm * 2.0 - 1.0
-    else:
-        raise ValueError('unknown norm_method')
-
-    return image_norm
-
-
-def unnormalize_image(image, image_type, norm_method='global_minmax'):
-    assert norm_method == 'global_minmax', \
-        'only support global_minmax for norm_method'
-
-    if image_type == 'he':
-        stat = HE_STAT
-    elif image_type == 'ihc':
-        stat = IHC_STAT
-    else:
-        raise ValueError('unknown image_type')
-
-    if norm_method == 'channel_zscore':
-        if image.ndims == 3:
-            mean_ = stat['channel_mean']
-            std_  = stat['channel_std']
-        elif image.ndims == 4:
-            mean_ = stat['channel_mean'][None, ...]
-            std_  = stat['channel_std'][None, ...]
-        image_unnorm = image * std_ + mean_
-    elif norm_method == 'global_zscore':
-        image_unnorm = image * stat['global_std'] + stat['global_mean']
-    elif norm_method == 'global_minmax':
-        image_unnorm = (image + 1.0) / 2.0
-        global_range = stat['global_max'] - stat['global_min']
-        image_unnorm = image_unnorm * global_range + stat['global_min']
-    else:
-        raise ValueError('unknown norm_method')
-
-    return image_unnorm
-
-
 def tta(image, no):
     if no == 0:
         return image
@@ -173,3 +113,64 @@ def untta(image, no):
         return image.transpose(1, 0, 2)
     else:
         raise NotImplemented('unknown no for untta')
+
+
+def build_pyramid(he, ihc, spec):
+    # downsampled targets for lowres output of G and depths of D,
+    # images in (b, c, h, w), keys are ihc_lr, ihc_{depth}, he_{depth}
+
+    pyramid = {}
+    if spec['lowres_scale'] > 0:
+        h, w = ihc.shape[-2:]
+        size = (h // spec['lowres_scale'], w // spec['lowres_scale'])
+        pyramid['ihc_lr'] = F.interpolate(
+            ihc, size=size, mode='bilinear', align_corners=True
+        )
+
+    images = [('ihc', ihc), ('he', he)] if spec['with_he'] else [('ihc', ihc)]
+    for name, image in images:
+        downsamples = downsample_pyramid(image, spec['depths'])
+        for depth in range(1, spec['depths']):
+            pyramid[f'{name}_{depth}'] = downsamples[depth]
+
+    return pyramid
+
+
+def get_memory_format(x):
+    # channels last if x in (b, c, h, w) is stored as (b, h, w, c)
+
+    if (x.dim() == 4) and (not x.is_contiguous()) and \
+            x.is_contiguous(memory_format=torch.channels_last):
+        return torch.channels_last
+
+    return torch.contiguous_format
+
+
+def crop_images(image, crop_idx, crop_size):
+    # crop of each image in (b, c, h, w) at (row, col) in crop_idx,
+    # gathered on device of image without syncing offsets to host
+
+    num = image.size(0)
+    steps = torch.arange(crop_size, device=image.device)
+    crop_idx = crop_idx.to(image.device).long()
+    rows = crop_idx[:, 0:1] + steps
+    cols = crop_idx[:, 1:2] + steps
+
+    batch = torch.arange(num, device=image.device).view(num, 1, 1)
+    crops = image[batch, :, rows[:, :, None], cols[:, None, :]]
+    crops = crops.permute(0, 3, 1, 2)
+    crops = crops.contiguous(memory_format=get_memory_format(image))
+
+    return crops
+
+
+def crop_grid(image, crop_size):
+    # overlapping crops of single image in (1, c, h, w) with stride of
+    # half crop size, in order of product(crop_rows, crop_cols)
+
+    stride = crop_size // 2
+    crops = image[0].unfold(1, crop_size, stride).unfold(2, crop_size, stride)
+    crops = crops.permute(1, 2, 0, 3, 4).flatten(0, 1)
+    crops = crops.contiguous(memory_format=get_memory_format(image))
+
+    return crops
@@ -0,0 +1,68 @@
+# run from the root of repository: python -m misc.benchmark_norm
+
+import time
+import torch
+import numpy as np
+
+from libs.utils.norm import *
+from libs.utils.norm import _get_stat, _normalize_arith, _unnormalize_arith
+
+
+def reference_normalize(image, image_type, norm_method):
+    # previous path: float64 arithmetic, transpose and cast
+    image_norm = _normalize_arith(image, _get_stat(image_type), norm_method)
+    return image_norm.transpose(2, 0, 1).astype(np.float32)
+
+
+def reference_unnormalize(image, image_type, norm_method):
+    # previous path: transpose, arithmetic and cast
+    image = image.transpose(1, 2, 0)
+    image_unnorm = _unnormalize_arith(image, _get_stat(image_type), norm_method)
+    return image_unnorm.astype(np.uint8)
+
+
+def benchmark(func, sync, repeats=10):
+    func()  # warmup
+    sync()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    sync()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+if __name__ == '__main__':
+
+    np.random.seed(42)
+    batch = np.random.randint(0, 256, size=(8, 1024, 1024, 3), dtype=np.uint8)
+    image = batch[0]
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    batch_tensor = torch.from_numpy(batch).to(device)
+    sync = torch.cuda.synchronize if device == 'cuda' else (lambda: None)
+
+    for norm_method in NORM_METHODS:
+        ref = reference_normalize(image, 'he', norm_method)
+        lut = normalize_image(image, 'he', norm_method, channels_first=True)
+        lut_batch = normalize_batch(batch_tensor, 'he', norm_method)
+        same_numpy = np.array_equal(ref, lut)
+        same_torch = np.array_equal(ref, lut_batch[0].cpu().numpy())
+
+        pred = np.tanh(np.random.randn(3, 1024, 1024)).astype(np.float32)
+        pred_tensor = torch.from_numpy(pred)[None].to(device)
+        ref_inv = reference_unnormalize(pred, 'ihc', norm_method)
+        lut_inv = unnormalize_batch(pred_tensor, 'ihc', norm_method, to_uint8=True)
+        # float32 affine pass may truncate to the neighbouring integer
+        diff_inv = np.abs(ref_inv.astype(np.int16) - lut_inv[0].cpu().numpy()).max()
+
+        t_ref = benchmark(lambda: [reference_normalize(b, 'he', norm_method) for b in batch], sync)
+        t_lut = benchmark(lambda: [normalize_image(b, 'he', norm_method, True) for b in batch], sync)
+        t_dev = benchmark(lambda: normalize_batch(batch_tensor, 'he', norm_method), sync)
+        t_ref_inv = benchmark(lambda: reference_unnormalize(pred, 'ihc', norm_method), sync)
+        t_dev_inv = benchmark(lambda: unnormalize_batch(pred_tensor, 'ihc', norm_method, True), sync)
+
+        print(f'{norm_method}')
+        print(f'- identical to reference: numpy {same_numpy}, {device} {same_torch}, inverse max diff {diff_inv}')
+        print(f'- normalize 8 images    : reference {t_ref:8.2f} ms | numpy lut {t_lut:8.2f} ms | {device} lut {t_dev:8.2f} ms')
+        print(f'- unnormalize 1 image   : reference {t_ref_inv:8.2f} ms | {device} affine {t_dev_inv:8.2f} ms')
+        print()
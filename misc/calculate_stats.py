@@ -1,10 +1,12 @@
-import os
+# run from the root of repository: python -m misc.calculate_stats
+
 import gc
 import imageio
 import numpy as np
 
 from tqdm import tqdm
 from os.path import join as opj
+from libs.utils import load_manifest
 
 
 def load_image(image_path):
@@ -12,16 +14,16 @@ def load_image(image_path):
     return np.array(image)
 
 
-def get_mean_std(data_dir):
+def get_mean_std(data_dir, image_type):
 
-    files = os.listdir(data_dir)
+    files = [s[image_type] for s in load_manifest(data_dir)]
     data_list = [load_image(opj(data_dir, f))
                  for f in tqdm(files, ncols=66)]
     data_array = np.array(data_list)
     del data_list
     gc.collect()
 
-    print(data_dir)
+    print(opj(data_dir, image_type.upper()))
     print('mean:', np.mean(data_array, axis=(0, 1, 2)))
     print('std: ', np.std(data_array, axis=(0, 1, 2)))
     print('min: ', np.min(data_array, axis=(0, 1, 2)))
@@ -35,8 +37,7 @@ def get_mean_std(data_dir):
 
 if __name__ == '__main__':
 
-    he_dir  = './data/train/HE'
-    ihc_dir = './data/train/IHC'
+    data_dir = './data/train'
 
-    get_mean_std(he_dir)
-    get_mean_std(ihc_dir)
+    get_mean_std(data_dir, 'he')
+    get_mean_std(data_dir, 'ihc')
@@ -1,22 +1,26 @@
+# run from the root of repository: python -m misc.evaluate
+
 import os
 import cv2
 
 from tqdm import tqdm
 from skimage.metrics import structural_similarity
 from skimage.metrics import peak_signal_noise_ratio
+from libs.utils import load_manifest
 
 
 def psnr_and_ssim():
 
-    he_dir = './data/test/HE'
-    ihc_dir = './data/test/IHC'
+    data_dir = './data/test'
+    ihc_dir = os.path.join(data_dir, 'IHC')
 
     exp = 'style_translator/exp4'
     ihc_pred_dir = f'./evaluations/{exp}/model_best_psnr_tta/IHC_pred'
 
     psnr = []
     ssim = []
-    for i in tqdm(os.listdir(he_dir)):
+    files = [s['file'] for s in load_manifest(data_dir)]
+    for i in tqdm(files):
         fake = cv2.imread(os.path.join(ihc_dir, i))
         real = cv2.imread(os.path.join(ihc_pred_dir, i))
         PSNR = peak_signal_noise_ratio(fake, real)
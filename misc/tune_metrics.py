@@ -1,3 +1,5 @@
+# run from the root of repository: python -m misc.tune_metrics
+
 import os
 import torch
 import numpy as np
@@ -7,15 +9,16 @@ from tqdm import tqdm
 from piqa import SSIM, PSNR
 from skimage.metrics import structural_similarity
 from skimage.metrics import peak_signal_noise_ratio
+from libs.utils import load_manifest
 
 
 if __name__ == '__main__':
 
-    real_dir = './data/test/IHC'
+    data_dir = './data/test'
+    real_dir = os.path.join(data_dir, 'IHC')
     fake_dir = './outputs_test/resnet_mod_v2_exp3/model_best_psnr_tta/IHC_pred'
 
-    files = os.listdir(real_dir)
-    files.sort()
+    files = [s['file'] for s in load_manifest(data_dir)]
 
     sk_psnr_list, sk_ssim_list = [], []
     piqa_psnr_list, piqa_ssim_list = [], []
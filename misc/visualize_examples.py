@@ -1,19 +1,21 @@
-import os
+# run from the root of repository: python -m misc.visualize_examples
+
 import random
 import imageio.v2 as iio
 import matplotlib.pyplot as plt
 
 from os.path import join as opj
+from libs.utils import load_manifest
 
 
 if __name__ == '__main__':
 
-    he_dir = './data/test/HE'
-    ihc_dir = './data/test/IHC'
+    data_dir = './data/test'
+    he_dir = opj(data_dir, 'HE')
+    ihc_dir = opj(data_dir, 'IHC')
     ihc_pred_dir = './evaluations/stainer_basic_cmp/exp3/model_best_psnr_tta/IHC_pred'
 
-    files = os.listdir(he_dir)
-    files.sort()
+    files = [s['file'] for s in load_manifest(data_dir)]
 
     num_cols = 8
     num_rows = 3
@@ -1,16 +1,19 @@
-import os
+# run from the root of repository: python -m misc.visualize_generation
+
 import numpy as np
 import imageio.v2 as iio
 import matplotlib.pyplot as plt
 
 from tqdm import tqdm
 from os.path import join as opj
+from libs.utils import load_manifest
 
 
 if __name__ == '__main__':
 
-    he_dir = './data/test/HE'
-    ihc_dir = './data/test/IHC'
+    data_dir = './data/test'
+    he_dir = opj(data_dir, 'HE')
+    ihc_dir = opj(data_dir, 'IHC')
     exps = [
         'stainer_basic_cmp/exp1',
         'stainer_basic_cmp/exp2',
@@ -19,8 +22,7 @@ if __name__ == '__main__':
     ]
     ihc_pred_dir_base = './evaluations/{}/model_best_psnr_tta/IHC_pred'
 
-    files = os.listdir(he_dir)
-    files.sort()
+    files = [s['file'] for s in load_manifest(data_dir)]
 
     num_cols = 4
     num_rows = int(np.ceil(len(exps) / num_cols) + 1)
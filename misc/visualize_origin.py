@@ -1,17 +1,19 @@
-import os
+# run from the root of repository: python -m misc.visualize_origin
+
 import imageio.v2 as iio
 import matplotlib.pyplot as plt
 
 from tqdm import tqdm
 from os.path import join as opj
+from libs.utils import load_manifest
 
 
 if __name__ == '__main__':
 
-    he_dir = './data/test/HE'
-    ihc_dir = './data/test/IHC'
-    files = os.listdir(he_dir)
-    files.sort()
+    data_dir = './data/test'
+    he_dir = opj(data_dir, 'HE')
+    ihc_dir = opj(data_dir, 'IHC')
+    files = [s['file'] for s in load_manifest(data_dir)]
 
     for file in tqdm(files, ncols=66):
         he = iio.imread(opj(he_dir, file))
@@ -0,0 +1,42 @@
+import os
+import argparse
+
+from libs.utils import *
+
+
+def main(args):
+
+    # prints information
+    print('-' * 88)
+    print('Preparing BCI Dataset ...\n')
+    print(f'- Data  Dir : {args.data_dir}')
+    print(f'- Shards    : {args.build_shards}')
+    print(f'- Stream    : {args.build_stream}')
+    print(f'- Shard Size: {args.shard_size}', '\n')
+
+    build_manifest(args.data_dir, args.num_threads, args.rescan)
+    if args.build_shards:
+        build_shards(args.data_dir, shard_size=args.shard_size)
+    if args.build_stream:
+        build_stream(args.data_dir, shard_size=args.shard_size)
+
+    print('-' * 88, '\n')
+    return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Data Preparation for BCI Dataset')
+    parser.add_argument('--data_dir',     type=str, help='dir path of data')
+    parser.add_argument('--shard_size',   type=int, help='number of pairs in each shard', default=256)
+    parser.add_argument('--num_threads',  type=int, help='number of threads to scan pairs', default=16)
+    parser.add_argument('--rescan',       type=lambda x: (str(x).lower() == 'true'),
+                        help='if check size and mtime of scanned pairs', default=False)
+    parser.add_argument('--build_shards', type=lambda x: (str(x).lower() == 'true'),
+                        help='if pack pairs into shards', default=True)
+    parser.add_argument('--build_stream', type=lambda x: (str(x).lower() == 'true'),
+                        help='if pack encoded pairs into tar shards for streaming', default=False)
+    args = parser.parse_args()
+
+    check_prepare_args(args)
+    main(args)
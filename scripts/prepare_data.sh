@@ -0,0 +1,18 @@
+#!/bin/bash
+
+
+# builds manifest of pairs, datasets and evaluators load it
+# instead of listing data directories
+python prepare_data.py            \
+    --data_dir     ./data/test    \
+    --build_shards false
+
+
+# packs decoded pairs into memory-mapped shards,
+# set "source: shards" in loader configs to use them
+for data_dir in ./data/train ./data/val
+do
+    python prepare_data.py          \
+        --data_dir   $data_dir      \
+        --shard_size 256
+done
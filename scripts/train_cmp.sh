@@ -0,0 +1,18 @@
+#!/bin/bash
+
+
+# settings
+device=3
+
+# configurations of experiment, set "pretrained_cmp: true" in
+# trainer configs, so that trainer of G loads C at start_cmp
+config_file=./configs/stainer_basic_cmp/exp3.yaml
+echo "Starting training of C on device: $device"
+
+# training of C, ahead of or concurrently with train.sh
+CUDA_VISIBLE_DEVICES=$device    \
+python train_cmp.py             \
+    --train_dir   ./data/train  \
+    --val_dir     ./data/val    \
+    --exp_root    ./experiments-4-batch-size \
+    --config_file $config_file
@@ -1,6 +1,5 @@
 import os
 import argparse
-import wandb
 
 from libs.utils import *
 from libs.train_cahr import *
@@ -13,8 +12,9 @@ def main(args):
     # loads configs
     configs = OmegaConf.load(args.config_file)
 
-    # initialize environments
-    init_environment(configs.seed)
+    # initialize environments, seed is different in each process
+    init_distributed_mode(args)
+    init_environment(configs.seed + get_rank())
     exp_dir = os.path.join(args.exp_root, configs.exp)
 
     # prints information
@@ -24,39 +24,42 @@ def main(args):
     print(f'-  Val  Dir: {args.val_dir}')
     print(f'-  Exp  Dir: {exp_dir}')
     print(f'- Configs  : {args.config_file}')
-    print(f'- Trainer  : {args.trainer}', '\n')
-
-    wandb.init(
-        # set the wandb project where this run will be logged
-        project="bci-stainer-retrained",
-        config={
-        "Train Dir": {args.train_dir},
-        "Val Dir": {args.val_dir},
-        "Exp Dir": {exp_dir},
-        "Configs": {args.config_file},
-        "Trainer": {args.trainer},
-        **configs
-        }
-    )
+    print(f'- Trainer  : {args.trainer}')
+    print(f'- Processes: {get_world_size()}', '\n')
 
     if args.trainer == 'basic':
-        # loads dataloder for training and validation
-        train_loader = get_dataloader('train', args.train_dir, configs.loader)
-        val_loader   = get_dataloader('val',   args.val_dir,   configs.loader)
-
         # initialize trainer
         trainer = BCITrainerBasic(configs, exp_dir, args.resume_ckpt)
 
-    elif args.trainer == 'cahr':
-        # loads dataloder for training and validation
-        train_loader = get_cahr_dataloader('train', args.train_dir, configs.loader)
-        val_loader   = get_cahr_dataloader('val',   args.val_dir,   configs.loader)
+        # loads dataloder for training and validation,
+        # downsampled targets are decided by models of trainer
+        pyramid = trainer.loader_pyramid
+        train_loader = get_dataloader(
+            'train', args.train_dir, configs.loader, pyramid,
+            with_index=trainer.latent_cache, seed=configs.seed
+        )
+        val_loader   = get_dataloader('val',   args.val_dir,   configs.loader)
 
+    elif args.trainer == 'cahr':
         # initialize trainer
         trainer = BCITrainerCAHR(configs, exp_dir, args.resume_ckpt)
 
+        # loads dataloder for training and validation,
+        # downsampled targets are decided by models of trainer
+        pyramid = trainer.loader_pyramid
+        train_loader = get_cahr_dataloader(
+            'train', args.train_dir, configs.loader, pyramid,
+            with_index=trainer.latent_cache, seed=configs.seed
+        )
+        val_loader   = get_cahr_dataloader('val',   args.val_dir,   configs.loader)
+
+    # training samples without augmentation for latents of frozen C
+    latent_loader = None
+    if trainer.latent_cache:
+        latent_loader = get_dataloader('latent', args.train_dir, configs.loader)
+
     # training model
-    trainer.forward(train_loader, val_loader)
+    trainer.forward(train_loader, val_loader, latent_loader)
 
     print('-' * 100, '\n')
     return
@@ -71,6 +74,7 @@ if __name__ == '__main__':
     parser.add_argument('--config_file', type=str, help='yaml path of configs')
     parser.add_argument('--resume_ckpt', type=str, help='checkpoint path for resuming')
     parser.add_argument('--trainer',     type=str, help='trainer type, basic or cahr', default='basic')
+    parser.add_argument('--launcher',    type=str, help='none, or pytorch for torchrun', default='none')
     args = parser.parse_args()
 
     check_train_args(args)
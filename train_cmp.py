@@ -0,0 +1,59 @@
+import os
+import argparse
+
+from libs.utils import *
+from libs.train_cmp import *
+from libs.train_basic import get_dataloader
+from omegaconf import OmegaConf
+
+
+def main(args):
+
+    # loads configs
+    configs = OmegaConf.load(args.config_file)
+
+    # initialize environments, seed is different in each process
+    init_distributed_mode(args)
+    init_environment(configs.seed + get_rank())
+
+    # C is saved in cmp dir of experiment, where trainers of G find it
+    exp_dir = os.path.join(args.exp_root, configs.exp, 'cmp')
+
+    # prints information
+    print('-' * 100)
+    print('Training Comparator for BCI Dataset ...\n')
+    print(f'- Train Dir: {args.train_dir}')
+    print(f'-  Val  Dir: {args.val_dir}')
+    print(f'-  Exp  Dir: {exp_dir}')
+    print(f'- Configs  : {args.config_file}')
+    print(f'- Processes: {get_world_size()}', '\n')
+
+    # initialize trainer
+    trainer = BCITrainerCmp(configs, exp_dir, args.resume_ckpt)
+
+    # loads dataloder for training and validation
+    train_loader = get_dataloader('train', args.train_dir, configs.loader, seed=configs.seed)
+    val_loader   = get_dataloader('val',   args.val_dir,   configs.loader)
+
+    # training model
+    trainer.forward(train_loader, val_loader)
+
+    print('-' * 100, '\n')
+    return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Training Comparator for BCI Dataset')
+    parser.add_argument('--train_dir',   type=str, help='dir path of training data')
+    parser.add_argument('--val_dir',     type=str, help='dir path of validation data')
+    parser.add_argument('--exp_root',    type=str, help='root dir of experiment')
+    parser.add_argument('--config_file', type=str, help='yaml path of configs')
+    parser.add_argument('--resume_ckpt', type=str, help='checkpoint path for resuming')
+    parser.add_argument('--launcher',    type=str, help='none, or pytorch for torchrun', default='none')
+    args = parser.parse_args()
+
+    # C is trained in the same way for both trainers of G
+    args.trainer = 'basic'
+    check_train_args(args)
+    main(args)